@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+'''
+End-to-end msfbot benchmark against the local msfrpcd simulator
+
+Runs msfbot.main() in-process against msfrpcd_sim for every combination of
+session count and RPC latency, stops once every session has been onboarded
+(attack_with_session returned) or the run times out, and appends the results
+to a JSON file so runs from different versions can be compared.
+'''
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import platform
+import contextlib
+import subprocess
+import msfbot
+from msfrpcd_sim import MsfrpcdSim
+
+PHASES = ['sess_first_check', 'domain_recon', 'run_userhunter', 'get_passwords', 'attack_with_session']
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sessions", default="1,10,100,500", help="Comma separated session counts")
+    parser.add_argument("-l", "--latency", default="0,0.01", help="Comma separated RPC latencies in seconds")
+    parser.add_argument("--jitter", default=0, type=float, help="Random extra RPC latency in seconds")
+    parser.add_argument("--cmd-delay", default=0.05, type=float, help="Seconds before simulated command output is available")
+    parser.add_argument("--consoles", default=5, type=int, help="Consoles that already exist on the simulator")
+    parser.add_argument("-t", "--timeout", default=600, type=float, help="Seconds before a run is stopped")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON file results are appended to")
+    parser.add_argument("--msfbot-args", default="", help="Extra msfbot arguments, e.g. \"--max-in-flight 20\"")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show msfbot output")
+    return parser.parse_args()
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.DEVNULL)
+        return out.decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Recorder:
+    '''
+    Collects per-phase wall times, onboarding timestamps and event loop stalls
+    '''
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.phases = dict((p, []) for p in PHASES)
+        self.onboarded = []
+        self.start = None
+        self.stall_total = 0
+        self.stall_max = 0
+        self.done = None
+
+    def timed(self, name, func):
+        async def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.phases[name].append(time.monotonic() - start)
+                if name == 'attack_with_session':
+                    self.onboarded.append(time.monotonic())
+                    if len(self.onboarded) >= self.sessions:
+                        self.done.set()
+        return wrapper
+
+    async def watch_loop(self, interval=0.01):
+        # Anything that holds the loop shows up as lateness of this sleep
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(interval)
+            late = time.monotonic() - before - interval
+            if late > 0.001:
+                self.stall_total += late
+                self.stall_max = max(self.stall_max, late)
+
+    async def stop_when_done(self, timeout):
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        msfbot.kill_tasks()
+
+    def phase_stats(self):
+        stats = {}
+        for name, times in self.phases.items():
+            if not times:
+                stats[name] = {'count': 0}
+                continue
+            times = sorted(times)
+            stats[name] = {'count': len(times),
+                           'total': round(sum(times), 3),
+                           'mean': round(sum(times) / len(times), 3),
+                           'p95': round(times[int(0.95 * (len(times) - 1))], 3),
+                           'max': round(times[-1], 3)}
+        return stats
+
+def run_once(opts, sessions, latency):
+    server = MsfrpcdSim(('127.0.0.1', 0),
+                        sessions=sessions,
+                        consoles=opts.consoles,
+                        latency=latency,
+                        jitter=opts.jitter,
+                        cmd_delay=opts.cmd_delay,
+                        seed=1)
+    server.start()
+    port = server.server_address[1]
+
+    msfbot.args = msfbot.parse_args(['--rpc', '127.0.0.1:{}'.format(port)] + opts.msfbot_args.split())
+    recorder = Recorder(sessions)
+    originals = dict((p, getattr(msfbot, p)) for p in PHASES)
+    for name, func in originals.items():
+        setattr(msfbot, name, recorder.timed(name, func))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    recorder.done = asyncio.Event()
+    loop.create_task(recorder.watch_loop())
+    loop.create_task(recorder.stop_when_done(opts.timeout))
+
+    out = sys.stdout if opts.verbose else open(os.devnull, 'w')
+    recorder.start = time.monotonic()
+    try:
+        with contextlib.redirect_stdout(out):
+            msfbot.main()
+    except SystemExit:
+        pass
+    finally:
+        wall_time = time.monotonic() - recorder.start
+        for name, func in originals.items():
+            setattr(msfbot, name, func)
+        server.shutdown()
+        server.server_close()
+        if out is not sys.stdout:
+            out.close()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    onboarded = len(recorder.onboarded)
+    onboard_time = recorder.onboarded[-1] - recorder.start if onboarded else None
+    rpc_calls = sum(server.stats.values())
+
+    return {'sessions': sessions,
+            'latency': latency,
+            'jitter': opts.jitter,
+            'onboarded': onboarded,
+            'timed_out': onboarded < sessions,
+            'wall_time': round(wall_time, 3),
+            'sessions_per_minute': round(onboarded / onboard_time * 60, 2) if onboard_time else 0,
+            'rpc_calls': rpc_calls,
+            'rpc_calls_per_session': round(rpc_calls / sessions, 1),
+            'rpc_calls_by_method': dict(sorted(server.stats.items())),
+            'phases': recorder.phase_stats(),
+            'loop_stall': {'total': round(recorder.stall_total, 3),
+                           'max': round(recorder.stall_max, 3)}}
+
+def print_result(r):
+    print('[*] {:>4} sessions, {:.3f}s latency: {}/{} onboarded in {}s, {} sessions/min, '
+          '{} RPC calls/session, {}s loop stall'.format(r['sessions'], r['latency'], r['onboarded'],
+                                                         r['sessions'], r['wall_time'], r['sessions_per_minute'],
+                                                         r['rpc_calls_per_session'], r['loop_stall']['total']))
+    for name, stats in r['phases'].items():
+        if stats['count']:
+            print('        {:<20} n={:<4} mean={}s max={}s'.format(name, stats['count'], stats['mean'], stats['max']))
+
+def save_results(path, doc):
+    results = []
+    if os.path.exists(path):
+        with open(path) as f:
+            results = json.load(f)
+    results.append(doc)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def main():
+    opts = parse_args()
+    session_counts = [int(x) for x in opts.sessions.split(',')]
+    latencies = [float(x) for x in opts.latency.split(',')]
+
+    doc = {'revision': git_revision(),
+           'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(),
+           'runs': []}
+
+    for sessions in session_counts:
+        for latency in latencies:
+            result = run_once(opts, sessions, latency)
+            print_result(result)
+            doc['runs'].append(result)
+
+    save_results(opts.output, doc)
+    print('[*] Results written to {}'.format(opts.output))
+
+if __name__ == "__main__":
+    main()
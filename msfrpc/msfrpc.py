@@ -20,8 +20,13 @@
 # USA
 #
 
+import time
+import asyncio
 import msgpack
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 
 class MsfError(Exception):
@@ -37,6 +42,74 @@ class MsfAuthError(MsfError):
         self.msg = msg
 
 
+class RpcStats:
+    '''
+    Per-method call counts, payload sizes, error counts and latency
+    histograms. Updated from worker threads so every change takes the lock.
+    Latency buckets are upper bounds in milliseconds.
+    '''
+
+    buckets = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.methods = {}
+
+    def method(self, name):
+        if name not in self.methods:
+            self.methods[name] = {'calls': 0,
+                                  'coalesced': 0,
+                                  'errors': 0,
+                                  'bytes_sent': 0,
+                                  'bytes_received': 0,
+                                  'latency_total': 0.0,
+                                  'latency_max': 0.0,
+                                  'histogram': [0] * (len(self.buckets) + 1)}
+        return self.methods[name]
+
+    def record(self, name, secs, bytes_sent, bytes_received, error):
+        ms = secs * 1000
+        bucket = len(self.buckets)
+        for num, limit in enumerate(self.buckets):
+            if ms <= limit:
+                bucket = num
+                break
+
+        with self.lock:
+            m = self.method(name)
+            m['calls'] += 1
+            m['bytes_sent'] += bytes_sent
+            m['bytes_received'] += bytes_received
+            m['latency_total'] += secs
+            m['latency_max'] = max(m['latency_max'], secs)
+            m['histogram'][bucket] += 1
+            if error:
+                m['errors'] += 1
+
+    def record_coalesced(self, name):
+        with self.lock:
+            self.method(name)['coalesced'] += 1
+
+    def snapshot(self):
+        labels = ['<={}ms'.format(b) for b in self.buckets] + ['>{}ms'.format(self.buckets[-1])]
+        methods = {}
+        with self.lock:
+            for name, m in self.methods.items():
+                methods[name] = {'calls': m['calls'],
+                                 'coalesced': m['coalesced'],
+                                 'errors': m['errors'],
+                                 'bytes_sent': m['bytes_sent'],
+                                 'bytes_received': m['bytes_received'],
+                                 'latency_mean': m['latency_total'] / m['calls'] if m['calls'] else 0,
+                                 'latency_max': m['latency_max'],
+                                 'latency_total': m['latency_total'],
+                                 'histogram': dict(zip(labels, m['histogram']))}
+        return {'started': self.started,
+                'uptime': time.time() - self.started,
+                'methods': methods}
+
+
 class Msfrpc:
 
     def __init__(self, opts=[]):
@@ -44,14 +117,78 @@ class Msfrpc:
         self.port = opts.get('port') or "55552"
         self.uri = opts.get('uri') or "/api/"
         self.ssl = opts.get('ssl') or False
+        self.verify = opts.get('verify', True)
+        self.timeout = opts.get('timeout') or None
+        self.pool_size = opts.get('pool_size') or 10
+        self.read_size = opts.get('read_size') or 65536
+        self.str_keys = opts.get('str_keys') or False
         self.token = None
         self.headers = {"Content-type": "binary/message-pack"}
+        self.stats = RpcStats()
+
+        if self.ssl is True:
+            self.url = "https://%s:%s%s" % (self.host, self.port, self.uri)
+        else:
+            self.url = "http://%s:%s%s" % (self.host, self.port, self.uri)
+
+        self.session = self.create_session()
+
+    def create_session(self):
+        # One keep-alive session for every call so msfrpcd sees a handful of
+        # long lived sockets and TLS sessions get reused rather than
+        # renegotiated on every RPC
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size,
+                              pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(self.headers)
+        session.verify = self.verify
+        return session
+
+    def close(self):
+        self.session.close()
 
     def encode(self, data):
         return msgpack.packb(data)
 
+    def create_unpacker(self):
+        # raw=True keeps every string as bytes regardless of msgpack version,
+        # str_keys only decodes map keys so binary payloads stay untouched.
+        # session.list is keyed by integer session IDs hence strict_map_key
+        if self.str_keys is True:
+            return msgpack.Unpacker(raw=True, strict_map_key=False,
+                                    object_pairs_hook=self.str_key_pairs)
+        return msgpack.Unpacker(raw=True, strict_map_key=False)
+
+    @staticmethod
+    def str_key_pairs(pairs):
+        return dict((k.decode('utf8') if isinstance(k, bytes) else k, v) for k, v in pairs)
+
+    def key(self, name):
+        return name if self.str_keys is True else name.encode()
+
     def decode(self, data):
-        return msgpack.unpackb(data)
+        unpacker = self.create_unpacker()
+        unpacker.feed(data)
+        return unpacker.unpack()
+
+    def decode_stream(self, r):
+        '''
+        Feed the response to the unpacker as it comes off the socket rather
+        than joining the whole body first. Reading to the end also hands the
+        connection back to the pool.
+        '''
+        unpacker = self.create_unpacker()
+        size = 0
+        try:
+            for chunk in r.iter_content(chunk_size=self.read_size):
+                size += len(chunk)
+                unpacker.feed(chunk)
+        finally:
+            r.close()
+        return unpacker.unpack(), size
 
     def call(self, method, opts=[]):
         if method != 'auth.login':
@@ -59,27 +196,280 @@ class Msfrpc:
                 raise MsfAuthError("MsfRPC: Not Authenticated")
 
         if method != "auth.login":
-            opts.insert(0, self.token)
-
-        if self.ssl is True:
-            url = "https://%s:%s%s" % (self.host, self.port, self.uri)
-        else:
-            url = "http://%s:%s%s" % (self.host, self.port, self.uri)
-
-        opts.insert(0, method)
-        payload = self.encode(opts)
+            opts = [self.token] + list(opts)
 
-        r = requests.post(url, data=payload, headers=self.headers)
+        payload = self.encode([method] + list(opts))
 
-        opts[:] = []  # Clear opts list
+        start = time.monotonic()
+        received = 0
+        error = True
+        try:
+            r = self.session.post(self.url, data=payload, timeout=self.timeout, stream=True)
+            res, received = self.decode_stream(r)
+            error = isinstance(res, dict) and self.key('error') in res
+            return res
+        finally:
+            self.stats.record(method, time.monotonic() - start, len(payload), received, error)
 
-        return self.decode(r.content)
+    def stats_snapshot(self):
+        return self.stats.snapshot()
 
     def login(self, user, password):
         auth = self.call("auth.login", [user, password])
         try:
-            if auth[b'result'] == b'success':
-                self.token = auth[b'token']
+            if auth[self.key('result')] == b'success':
+                self.token = auth[self.key('token')]
+                return True
+        except:
+            raise MsfAuthError("MsfRPC: Authentication failed")
+
+
+class AsyncMsfrpc(Msfrpc):
+    '''
+    Awaitable client with the same call() and login() as Msfrpc. Each RPC
+    runs on a worker thread sharing the pooled HTTP session so requests
+    from different coroutines overlap instead of blocking the event loop.
+    max_in_flight caps the number of concurrent requests to msfrpcd.
+
+    Read-only methods listed in coalesce_methods are single-flighted:
+    identical concurrent calls share one request and its result, and the
+    result is reused for cache_ttl seconds. Results are shared objects so
+    callers must copy them before modifying.
+    '''
+
+    def __init__(self, opts=[]):
+        self.max_in_flight = opts.get('max_in_flight') or 10
+        self.cache_ttl = opts.get('cache_ttl', 0.25)
+        self.coalesce_methods = opts.get('coalesce_methods') or ('console.list',
+                                                                  'session.list',
+                                                                  'job.list')
+        if not opts.get('pool_size'):
+            opts = dict(opts, pool_size=self.max_in_flight)
+        super().__init__(opts)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        self.semaphore = None
+        self.inflight = {}
+        self.cache = {}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        super().close()
+
+    async def call(self, method, opts=[]):
+        if method in self.coalesce_methods:
+            return await self.coalesced_call(method, opts)
+        return await self.threaded_call(method, opts)
+
+    async def threaded_call(self, method, opts):
+        # Semaphore is created lazily so it binds to the running loop
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        loop = asyncio.get_event_loop()
+        async with self.semaphore:
+            return await loop.run_in_executor(self.executor, super().call, method, list(opts))
+
+    async def coalesced_call(self, method, opts):
+        key = (method, self.encode(list(opts)))
+        now = asyncio.get_event_loop().time()
+
+        cached = self.cache.get(key)
+        if cached and now - cached[0] < self.cache_ttl:
+            self.stats.record_coalesced(method)
+            return cached[1]
+
+        fut = self.inflight.get(key)
+        if fut is not None:
+            self.stats.record_coalesced(method)
+        else:
+            fut = asyncio.ensure_future(self.threaded_call(method, opts))
+            fut.add_done_callback(lambda f: self.finish_coalesced(key, f))
+            self.inflight[key] = fut
+
+        # Shield so one cancelled waiter doesn't cancel the shared request
+        return await asyncio.shield(fut)
+
+    def finish_coalesced(self, key, fut):
+        self.inflight.pop(key, None)
+        if not fut.cancelled() and fut.exception() is None:
+            self.cache[key] = (asyncio.get_event_loop().time(), fut.result())
+        else:
+            self.cache.pop(key, None)
+
+    async def login(self, user, password):
+        auth = await self.call("auth.login", [user, password])
+        try:
+            if auth[self.key('result')] == b'success':
+                self.token = auth[self.key('token')]
                 return True
         except:
             raise MsfAuthError("MsfRPC: Authentication failed")
+
+
+class MergedDict(dict):
+    '''
+    A session.list or job.list merged across backends. failed holds the
+    indexes of backends whose call returned an error, their entries are
+    missing from the merge rather than gone
+    '''
+
+    def __init__(self):
+        dict.__init__(self)
+        self.failed = []
+
+
+class ShardedMsfrpc:
+    '''
+    Spreads work over several msfrpcd instances behind the AsyncMsfrpc
+    interface. Session, console and job IDs from backend i of n are mapped
+    to local_id * n + i so every ID is unique across backends and still
+    tells us which backend owns it. session.list, console.list and
+    job.list are merged, new consoles and module runs go to the backend
+    with the fewest consoles or jobs, and calls naming an ID are routed
+    to the backend that owns it. Merged lists come back as a MergedDict
+    naming any backends that errored. Pass backend= to call() to send a new
+    console or module run to a given backend instead, e.g. one picked
+    with pick_backend() whose LHOST it needs.
+    '''
+
+    id_methods = ('session.', 'console.', 'job.')
+    new_id_keys = {'console.create': 'id', 'module.execute': 'job_id'}
+    broadcast_methods = ('auth.token_add', 'auth.token_remove', 'auth.logout')
+
+    def __init__(self, clients):
+        self.clients = list(clients)
+        self.backend_count = len(self.clients)
+        self.load = dict((m, [0] * self.backend_count) for m in self.new_id_keys)
+
+    @property
+    def token(self):
+        return self.clients[0].token
+
+    @token.setter
+    def token(self, token):
+        for c in self.clients:
+            c.token = token
+
+    @property
+    def str_keys(self):
+        return self.clients[0].str_keys
+
+    def key(self, name):
+        return self.clients[0].key(name)
+
+    def to_global(self, local_id, idx):
+        gid = int(local_id) * self.backend_count + idx
+        return self.same_type(gid, local_id)
+
+    def to_local(self, gid):
+        idx = int(gid) % self.backend_count
+        local_id = int(gid) // self.backend_count
+        return idx, self.same_type(local_id, gid)
+
+    @staticmethod
+    def same_type(num, like):
+        if isinstance(like, bytes):
+            return str(num).encode()
+        if isinstance(like, str):
+            return str(num)
+        return num
+
+    def backend_for(self, gid):
+        return self.clients[self.to_local(gid)[0]]
+
+    def pick_backend(self, method):
+        load = self.load[method]
+        return load.index(min(load))
+
+    def least_loaded(self, method, backend=None):
+        idx = self.pick_backend(method) if backend is None else backend
+        self.load[method][idx] += 1
+        return idx
+
+    async def call(self, method, opts=[], backend=None):
+        opts = list(opts)
+
+        if self.backend_count == 1:
+            return await self.clients[0].call(method, opts)
+
+        if method in self.broadcast_methods:
+            results = await asyncio.gather(*[c.call(method, opts) for c in self.clients])
+            return results[0]
+
+        if method in ('session.list', 'job.list'):
+            return await self.merged_dict(method)
+
+        if method == 'console.list':
+            return await self.merged_consoles()
+
+        if method in self.new_id_keys:
+            idx = self.least_loaded(method, backend)
+            res = await self.clients[idx].call(method, opts)
+            key = self.key(self.new_id_keys[method])
+            if isinstance(res, dict) and key in res:
+                res = dict(res)
+                res[key] = self.to_global(res[key], idx)
+            return res
+
+        if method.startswith(self.id_methods) and opts:
+            idx, opts[0] = self.to_local(opts[0])
+            return await self.clients[idx].call(method, opts)
+
+        return await self.clients[0].call(method, opts)
+
+    async def merged_dict(self, method):
+        results = await asyncio.gather(*[c.call(method) for c in self.clients])
+        merged = MergedDict()
+        for idx, res in enumerate(results):
+            if not isinstance(res, dict) or self.key('error') in res:
+                merged.failed.append(idx)
+                continue
+            if method == 'job.list':
+                self.load['module.execute'][idx] = len(res)
+            for local_id, val in res.items():
+                merged[self.to_global(local_id, idx)] = val
+        return merged
+
+    async def merged_consoles(self):
+        consoles_key = self.key('consoles')
+        id_key = self.key('id')
+        results = await asyncio.gather(*[c.call('console.list') for c in self.clients])
+        consoles = []
+        for idx, res in enumerate(results):
+            backend_consoles = res.get(consoles_key, [])
+            self.load['console.create'][idx] = len(backend_consoles)
+            for c in backend_consoles:
+                c = dict(c)
+                c[id_key] = self.to_global(c[id_key], idx)
+                consoles.append(c)
+        return {consoles_key: consoles}
+
+    async def login(self, user, password):
+        results = await asyncio.gather(*[c.login(user, password) for c in self.clients])
+        return all(results)
+
+    def close(self):
+        for c in self.clients:
+            c.close()
+
+    def stats_snapshot(self):
+        backends = dict((c.url, c.stats_snapshot()) for c in self.clients)
+        methods = {}
+        for snap in backends.values():
+            for name, m in snap['methods'].items():
+                if name not in methods:
+                    methods[name] = dict(m, histogram=dict(m['histogram']))
+                    continue
+                total = methods[name]
+                for k in ('calls', 'coalesced', 'errors', 'bytes_sent', 'bytes_received', 'latency_total'):
+                    total[k] += m[k]
+                total['latency_max'] = max(total['latency_max'], m['latency_max'])
+                for bucket, count in m['histogram'].items():
+                    total['histogram'][bucket] += count
+        for m in methods.values():
+            m['latency_mean'] = m['latency_total'] / m['calls'] if m['calls'] else 0
+        started = min(s['started'] for s in backends.values())
+        return {'started': started,
+                'uptime': time.time() - started,
+                'methods': methods,
+                'backends': backends}
@@ -0,0 +1,693 @@
+#!/usr/bin/env python3
+
+'''
+Local msfrpcd stand-in for running msfbot without Metasploit
+
+Speaks msgpack over HTTP like the msgrpc plugin and implements the part of
+the API msfbot uses: auth.*, console.*, module.execute, job.*, session.list
+and session.meterpreter_read/_write/_run_single. module.execute jobs follow
+the same console rules and finish after the rule's delay. Command output comes from
+built-in defaults that mimic a small Windows domain, optionally overridden by
+a JSON fixtures file:
+
+    {"env": {"DOMAIN": "corp"},
+     "session": [{"match": "^sysinfo", "output": "...", "delay": 0.2}],
+     "shell":   [{"match": "^whoami", "output": "corp\\\\bob"}],
+     "console": [{"module": "smb_login", "per_host": "...", "admin_every": 3}]}
+
+"match"/"module" are regexes tried in order before the defaults. Outputs are
+str.format templates; {sess_num}, {ip}, {user}, {domain}, {dc}, {rhost},
+{lhost}, {smbuser}, {smbpass}, {smbdomain} and {new_sess_num} are filled in.
+A session rule with "psh_busy" keeps the PowerShell extension busy for that
+many seconds, like a long running powershell_execute.
+'''
+
+import os
+import re
+import sys
+import json
+import shutil
+import time
+import random
+import msgpack
+import argparse
+import tempfile
+import threading
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", default=55552, type=int, help="Port to listen on")
+    parser.add_argument("-u", "--username", default="msf", help="Username for msfrpc")
+    parser.add_argument("-p", "--password", default="123", help="Password for msfrpc")
+    parser.add_argument("-f", "--fixtures", help="JSON fixtures file")
+    parser.add_argument("--sessions", default=1, type=int, help="Number of simulated meterpreter sessions")
+    parser.add_argument("--session-interval", default=0, type=float, help="Seconds between new sessions appearing")
+    parser.add_argument("--admin-every", default=1, type=int, help="Every Nth session is an admin shell")
+    parser.add_argument("--consoles", default=0, type=int, help="Number of consoles that already exist")
+    parser.add_argument("--latency", default=0, type=float, help="Seconds added to every RPC")
+    parser.add_argument("--jitter", default=0, type=float, help="Random extra seconds added to every RPC")
+    parser.add_argument("--cmd-delay", default=0.1, type=float, help="Seconds before command output is available")
+    parser.add_argument("--seed", type=int, help="Random seed for jitter")
+    return parser.parse_args()
+
+SHELL_PROMPT = '\r\nC:\\Windows\\system32>'
+
+SHELL_BANNER = ('Process 4242 created.\n'
+                'Channel 1 created.\n'
+                'Microsoft Windows [Version 10.0.17134.1]\r\n'
+                '(c) 2018 Microsoft Corporation. All rights reserved.\r\n'
+                + SHELL_PROMPT)
+
+WIN_PRIVS = ('\nCurrent User\n'
+             '============\n\n'
+             ' Is Admin  Is System  Is In Local Admin Group  UAC Enabled  Foreground ID  UID\n'
+             ' --------  ---------  -----------------------  -----------  -------------  ---\n'
+             ' {admin}      False      {admin}                     False        1              "{domain}\\{user}"\n\n'
+             'Windows Privileges\n'
+             '==================\n\n'
+             ' Name\n'
+             ' ----\n'
+             ' SeChangeNotifyPrivilege\n'
+             ' SeShutdownPrivilege\n')
+
+PSH_TIMEOUT = '[-] Error running command powershell_execute: Rex::TimeoutError Operation timed out.\n'
+
+STAT_MISSING = '[-] stdapi_fs_stat: Operation failed: The system cannot find the file specified.\n'
+
+DEFAULT_SESSION_RULES = [
+    {'match': r'^sysinfo', 'output': ('Computer        : WIN10-{sess_num}\n'
+                                      'OS              : Windows 10 (Build 17134).\n'
+                                      'Architecture    : x64\n'
+                                      'System Language : en_US\n'
+                                      'Domain          : {DOMAIN}\n'
+                                      'Logged On Users : 2\n'
+                                      'Meterpreter     : x64/windows\n')},
+    {'match': r'^getuid', 'output': 'Server username: {domain}\\{user}\n'},
+    {'match': r'^getpid', 'output': 'Current pid: 1234\n'},
+    {'match': r'win_privs', 'output': WIN_PRIVS},
+    {'match': r'priv_migrate', 'output': ('[*] Current session process is explorer.exe (1234) as: {domain}\\{user}\n'
+                                         '[+] Already in explorer.exe (1234) as: {domain}\\{user}\n')},
+    {'match': r'^load ', 'output': 'Loading extension {arg}...Success.\n'},
+    {'match': r'^powershell_import', 'output': '[+] File successfully imported. No result was returned.\n'},
+    {'match': r'^powershell_execute .*write-host (.*?)["\']?$', 'output': '{group1}\n'},
+    {'match': r'^powershell_execute .*Test-Path', 'output': 'True\n'},
+    {'match': r'^powershell_execute .*Find-DomainUserLocation',
+     'output': PSH_TIMEOUT,
+     'delay': 1,
+     'psh_busy': 5},
+    {'match': r'^powershell_execute', 'output': '[+] Command execution completed:\n'},
+    {'match': r'^download ', 'output': '[*] Downloading: {arg} -> {local}\n[*] download   : {arg} -> {local}\n'},
+    {'match': r'^rm ', 'output': ''},
+    {'match': r'^stat ', 'output': ('Meta data for {arg}\n'
+                                    '=============\n\n'
+                                    'Mode              : 100666/rw-rw-rw-\n'
+                                    'Size              : 0\n'
+                                    'Type              : file\n')},
+    {'match': r'^wdigest', 'output': ('[+] Running as SYSTEM\n'
+                                      '[*] Retrieving wdigest credentials\n'
+                                      'wdigest credentials\n'
+                                      '===================\n\n'
+                                      'AuthID    Package    Domain        User           Password\n'
+                                      '------    -------    ------        ----           --------\n'
+                                      '0;995     Negotiate  NT AUTHORITY  IUSR           \n'
+                                      '0;{sess_num}4242  Kerberos   {DOMAIN}           {user}    Password{sess_num}!\n'
+                                      '    Password\n')},
+    {'match': r'^hashdump', 'output': ('Administrator:500:aad3b435b51404eeaad3b435b51404ee:31d6cfe0d16ae931b73c59d7e0c089c0:::\n'
+                                       'Guest:501:aad3b435b51404eeaad3b435b51404ee:31d6cfe0d16ae931b73c59d7e0c089c0:::\n')},
+    {'match': r'^shell$', 'output': SHELL_BANNER, 'shell': True},
+]
+
+DEFAULT_SHELL_RULES = [
+    {'match': r'^exit$', 'output': 'exit\r\n', 'exit': True},
+    {'match': r'^wmic NTDOMAIN', 'output': ('\r\n\r\nDomainControllerAddress=\r\nDomainName=\r\nRoles=\r\n\r\n\r\n'
+                                            'DomainControllerAddress=\\\\{dc}\r\nDomainName={DOMAIN}\r\nRoles=\r\n\r\n\r\n')},
+    {'match': r'^wmic path win32_groupuser', 'output': ('GroupComponent                                  PartComponent\r\n'
+                                                        'win32_group.domain="{domain}",name="domain admins"  '
+                                                        '\\\\WIN10-{sess_num}\\root\\cimv2:Win32_UserAccount.Domain="{domain}",Name="Administrator"\r\n'
+                                                        'win32_group.domain="{domain}",name="domain admins"  '
+                                                        '\\\\WIN10-{sess_num}\\root\\cimv2:Win32_UserAccount.Domain="{domain}",Name="dan.da"\r\n')},
+]
+
+DEFAULT_CONSOLE_RULES = [
+    {'module': r'smb_login',
+     'per_host': '[+] {host}:445         - {host}:445 - Success: \'{smbdomain}\\{smbuser}:{smbpass}\' Administrator\n',
+     'per_host_fail': '[-] {host}:445         - {host}:445 - Failed: \'{smbdomain}\\{smbuser}:{smbpass}\',\n',
+     'admin_every': 4,
+     'footer': '[*] Scanned 1 of 1 hosts (100% complete)\n[*] Auxiliary module execution completed\n',
+     'delay': 1},
+    {'module': r'psexec_psh',
+     'output': ('[*] Started HTTPS reverse handler on https://{lhost}:8443\n'
+                '[*] {rhost}:445 - Executing the payload...\n'
+                '[+] {rhost}:445 - Service start timed out, OK if running a command or non-service executable...\n'
+                '[*] Meterpreter session {new_sess_num} opened ({lhost}:8443 -> {rhost}:49158) at 2018-01-01 00:00:00 +0000\n'),
+     'new_session': True,
+     'delay': 2},
+    {'module': r'.*', 'output': '[*] Module execution completed\n'},
+]
+
+class SafeDict(dict):
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+def render(template, values):
+    return template.format_map(SafeDict(values))
+
+def match_rule(rules, text, key='match'):
+    for rule in rules:
+        m = re.search(rule[key], text, re.I)
+        if m:
+            return rule, m
+    return None, None
+
+class SimSession:
+
+    def __init__(self, sess_num, ip, user, domain, admin):
+        self.sess_num = sess_num
+        self.ip = ip
+        self.user = user
+        self.domain = domain
+        self.admin = admin
+        self.in_shell = False
+        self.pending = []
+        self.dead = False
+        self.psh_busy_until = 0
+        self.exploit_uuid = None
+
+    def info(self):
+        return {'type': 'meterpreter',
+                'tunnel_local': '10.0.0.1:8443',
+                'tunnel_peer': '{}:49158'.format(self.ip),
+                'via_exploit': 'exploit/multi/handler',
+                'via_payload': 'payload/windows/x64/meterpreter/reverse_https',
+                'desc': 'Meterpreter',
+                'info': '{}\\{} @ WIN10-{}'.format(self.domain.upper(), self.user, self.sess_num),
+                'workspace': 'false',
+                'session_host': self.ip,
+                'session_port': 49158,
+                'target_host': '',
+                'username': 'root',
+                'uuid': 'sim{}'.format(self.sess_num),
+                'exploit_uuid': self.exploit_uuid or 'simexploit{}'.format(self.sess_num),
+                'routes': '',
+                'arch': 'x64',
+                'platform': 'windows'}
+
+class SimConsole:
+
+    def __init__(self, c_id):
+        self.c_id = c_id
+        self.prompt = 'msf > '
+        self.busy_until = 0
+        self.pending = []
+
+    def busy(self, now):
+        return now < self.busy_until
+
+class SimJob:
+
+    def __init__(self, job_id, name, uuid, datastore, done_at, new_session):
+        self.job_id = job_id
+        self.name = name
+        self.uuid = uuid
+        self.datastore = datastore
+        self.start_time = int(time.time())
+        self.done_at = done_at
+        self.new_session = new_session
+
+class MsfrpcdSim(ThreadingMixIn, HTTPServer):
+    '''
+    Threaded HTTP server holding the simulated framework state. Can be run
+    from the command line or started in a background thread with start()
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, username='msf', password='123', fixtures=None,
+                 sessions=1, session_interval=0, admin_every=1, consoles=0,
+                 latency=0, jitter=0, cmd_delay=0.1, seed=None):
+        HTTPServer.__init__(self, address, RequestHandler)
+        fixtures = fixtures or {}
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.cmd_delay = cmd_delay
+        self.random = random.Random(seed)
+        self.state_lock = threading.Lock()
+        self.tokens = set()
+        self.stats = {}
+        self.env = dict({'DOMAIN': 'LAB', 'dc': '10.0.0.2', 'lhost': '10.0.0.1'}, **fixtures.get('env', {}))
+        self.session_rules = fixtures.get('session', []) + DEFAULT_SESSION_RULES
+        self.shell_rules = fixtures.get('shell', []) + DEFAULT_SHELL_RULES
+        self.console_rules = fixtures.get('console', []) + DEFAULT_CONSOLE_RULES
+        self.userhunter = fixtures.get('userhunter', 'IPAddress       : {dc}\r\n')
+        self.admin_every = max(admin_every, 1)
+
+        self.sessions = {}
+        self.num_sessions = sessions
+        self.session_interval = session_interval
+        self.next_sess_num = 1
+        self.start_time = time.time()
+
+        self.consoles = {}
+        self.next_c_id = 0
+        for x in range(consoles):
+            self.create_console()
+
+        self.jobs = {}
+        self.next_job_id = 0
+
+        # Downloads without an absolute destination land here, not in our cwd
+        self.download_dir = tempfile.mkdtemp(prefix='msfrpcd-sim-')
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def count(self, method):
+        self.stats[method] = self.stats.get(method, 0) + 1
+
+    def sleep(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def values(self, sess=None, **extra):
+        values = dict(self.env)
+        values['domain'] = self.env['DOMAIN'].lower()
+        if sess:
+            values.update({'sess_num': sess.sess_num,
+                           'ip': sess.ip,
+                           'user': sess.user,
+                           'domain': sess.domain,
+                           'admin': 'True' if sess.admin else 'False'})
+        values.update(extra)
+        return values
+
+    # Sessions
+
+    def add_session(self, ip=None, admin=None):
+        sess_num = self.next_sess_num
+        self.next_sess_num += 1
+        if admin is None:
+            admin = sess_num % self.admin_every == 0 or self.admin_every == 1
+        ip = ip or '10.0.{}.{}'.format(10 + sess_num // 250, sess_num % 250 + 1)
+        user = 'user{}'.format(sess_num)
+        sess = SimSession(sess_num, ip, user, self.env['DOMAIN'].lower(), admin)
+        self.sessions[sess_num] = sess
+        return sess
+
+    def spawn_due_sessions(self):
+        # Initial sessions appear either all at once or one per interval
+        while self.next_sess_num <= self.num_sessions:
+            due = self.start_time + (self.next_sess_num - 1) * self.session_interval
+            if time.time() < due:
+                break
+            self.add_session()
+
+    def get_session(self, sess_num):
+        try:
+            sess = self.sessions.get(int(sess_num))
+        except (TypeError, ValueError):
+            sess = None
+        if sess is None or sess.dead:
+            raise RpcError('Unknown Session ID {}'.format(sess_num))
+        return sess
+
+    def queue_output(self, target, data, delay=None):
+        if delay is None:
+            delay = self.cmd_delay
+        target.pending.append((time.time() + delay, data))
+
+    def take_output(self, target):
+        now = time.time()
+        ready = [d for t, d in target.pending if t <= now]
+        target.pending = [(t, d) for t, d in target.pending if t > now]
+        return ''.join(ready)
+
+    def run_session_cmd(self, sess, cmd):
+        cmd = cmd.strip()
+        if sess.in_shell:
+            for line in cmd.splitlines():
+                self.run_shell_line(sess, line.strip())
+            return
+
+        rule, m = match_rule(self.session_rules, cmd)
+        if not rule:
+            self.queue_output(sess, '[-] Unknown command: {}.\n'.format(cmd.split()[0]))
+            return
+
+        parts = cmd.split(None, 1)
+        arg = parts[1].strip('"\'') if len(parts) > 1 else ''
+        extra = {'arg': arg}
+        for num, group in enumerate(m.groups(), 1):
+            extra['group{}'.format(num)] = group
+
+        if cmd.startswith('download '):
+            extra['local'] = self.simulate_download(cmd)
+
+        # Files a PowerShell job writes don't exist until it's done
+        if cmd.startswith('stat ') and time.time() < sess.psh_busy_until:
+            self.queue_output(sess, STAT_MISSING, rule.get('delay'))
+            return
+
+        # The powershell extension runs one command at a time so anything
+        # sent while a long job is still going times out
+        if cmd.startswith('powershell_execute'):
+            if time.time() < sess.psh_busy_until:
+                self.queue_output(sess, PSH_TIMEOUT, rule.get('delay'))
+                return
+            sess.psh_busy_until = time.time() + rule.get('psh_busy', 0)
+
+        if rule.get('shell'):
+            sess.in_shell = True
+        self.queue_output(sess, render(rule.get('output', ''), self.values(sess, **extra)), rule.get('delay'))
+
+    def run_shell_line(self, sess, line):
+        if not line:
+            return
+        rule, m = match_rule(self.shell_rules, line)
+        if rule:
+            output = render(rule.get('output', ''), self.values(sess))
+            if rule.get('exit'):
+                sess.in_shell = False
+                self.queue_output(sess, output, rule.get('delay'))
+                return
+        elif line.lower().startswith('echo '):
+            output = self.shell_echo(sess, line[5:])
+        else:
+            output = "'{}' is not recognized as an internal or external command,\r\n".format(line.split()[0])
+
+        # cmd.exe echoes the typed line then prints the output and prompt
+        delay = rule.get('delay') if rule else None
+        self.queue_output(sess, line + '\r\n' + output + '\r\n' + SHELL_PROMPT, delay)
+
+    def shell_echo(self, sess, text):
+        env = {'WINDIR': 'C:\\Windows',
+               'USERPROFILE': 'C:\\Users\\{}'.format(sess.user),
+               'USERNAME': sess.user,
+               'USERDOMAIN': sess.domain.upper()}
+        text = re.sub(r'%(\w+)%', lambda m: env.get(m.group(1).upper(), m.group(0)), text)
+        # Carets escape the next character in cmd.exe
+        return re.sub(r'\^(.)', r'\1', text)
+
+    def simulate_download(self, cmd):
+        args = re.findall(r'"([^"]*)"|(\S+)', cmd)[1:]
+        args = [a or b for a, b in args]
+        remote = args[0]
+        basename = remote.replace('\\', '/').split('/')[-1]
+        if len(args) > 1:
+            local = args[1]
+            if local.endswith('/') or not local.rsplit('/', 1)[-1]:
+                local = local + basename
+        else:
+            local = basename
+        if not os.path.isabs(local):
+            local = os.path.join(self.download_dir, local)
+        content = render(self.userhunter, self.values())
+        try:
+            with open(local, 'wb') as f:
+                f.write(content.encode('utf16'))
+        except OSError:
+            pass
+        return local
+
+    # Consoles
+
+    def create_console(self):
+        c_id = str(self.next_c_id)
+        self.next_c_id += 1
+        self.consoles[c_id] = SimConsole(c_id)
+        return self.consoles[c_id]
+
+    def get_console(self, c_id):
+        console = self.consoles.get(str(c_id))
+        if console is None:
+            raise RpcError('Invalid console ID {}'.format(c_id))
+        return console
+
+    def run_console_cmd(self, console, data):
+        opts = {}
+        module = None
+        echo = ''
+        for line in data.splitlines():
+            parts = line.strip().split(None, 2)
+            if not parts:
+                continue
+            if parts[0] == 'use' and len(parts) > 1:
+                module = parts[1]
+            elif parts[0] == 'set' and len(parts) > 2:
+                opts[parts[1].lower()] = parts[2]
+                echo += '{} => {}\n'.format(parts[1], parts[2])
+
+        if module is None:
+            self.queue_output(console, echo)
+            return
+
+        rule, m = match_rule(self.console_rules, module, 'module')
+        values = self.values(rhost=opts.get('rhost', ''),
+                             lhost=opts.get('lhost', self.env['lhost']),
+                             smbuser=opts.get('smbuser', ''),
+                             smbpass=opts.get('smbpass', ''),
+                             smbdomain=opts.get('smbdomain', ''))
+
+        output = echo
+        if rule.get('new_session'):
+            sess = self.add_session(ip=values['rhost'], admin=True)
+            values['new_sess_num'] = sess.sess_num
+        if 'per_host' in rule:
+            for num, host in enumerate(self.console_hosts(opts.get('rhosts', '')), 1):
+                if num % rule.get('admin_every', 1) == 0:
+                    output += render(rule['per_host'], dict(values, host=host))
+                else:
+                    output += render(rule.get('per_host_fail', ''), dict(values, host=host))
+        output += render(rule.get('output', ''), values)
+        output += render(rule.get('footer', ''), values)
+
+        delay = rule.get('delay', self.cmd_delay)
+        console.busy_until = time.time() + delay
+        self.queue_output(console, output, delay)
+
+    # Jobs
+
+    def start_job(self, mod_type, name, opts):
+        opts = dict((k.lower(), str(v)) for k, v in opts.items())
+        rule, m = match_rule(self.console_rules, name, 'module')
+        job = SimJob(self.next_job_id,
+                     '{}: {}'.format(mod_type.capitalize(), name),
+                     ''.join(self.random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for x in range(8)),
+                     opts,
+                     time.time() + rule.get('delay', self.cmd_delay),
+                     rule.get('new_session', False))
+        self.next_job_id += 1
+        self.jobs[job.job_id] = job
+        return job
+
+    def reap_jobs(self):
+        # Exploit jobs open their session as they finish
+        now = time.time()
+        for job in [j for j in self.jobs.values() if j.done_at <= now]:
+            if job.new_session:
+                sess = self.add_session(ip=job.datastore.get('rhost'), admin=True)
+                sess.exploit_uuid = job.uuid
+            del self.jobs[job.job_id]
+
+    def get_job(self, job_id):
+        self.reap_jobs()
+        try:
+            return self.jobs[int(job_id)]
+        except (KeyError, TypeError, ValueError):
+            raise RpcError('Invalid Job')
+
+    def console_hosts(self, rhosts):
+        if rhosts.startswith('file:'):
+            try:
+                with open(rhosts[5:]) as f:
+                    return [l.strip() for l in f if l.strip()]
+            except OSError:
+                return []
+        return rhosts.split()
+
+    # RPC dispatch
+
+    def dispatch(self, method, args):
+        if method == 'auth.login':
+            if args[:2] == [self.username, self.password]:
+                token = 'TEMP' + ''.join(self.random.choice('0123456789abcdef') for x in range(28))
+                self.tokens.add(token)
+                return {'result': 'success', 'token': token}
+            raise RpcError('Login Failed', 401)
+
+        if not args or args[0] not in self.tokens:
+            raise RpcError('Invalid Authentication Token', 401)
+        args = args[1:]
+
+        handler = getattr(self, 'rpc_' + method.replace('.', '_'), None)
+        if handler is None:
+            raise RpcError('Unknown API Call: \'{}\''.format(method), 404)
+        return handler(*args)
+
+    def rpc_auth_token_add(self, token):
+        self.tokens.add(token)
+        return {'result': 'success'}
+
+    def rpc_auth_logout(self, token):
+        self.tokens.discard(token)
+        return {'result': 'success'}
+
+    def rpc_console_create(self, opts=None):
+        console = self.create_console()
+        return {'id': console.c_id, 'prompt': console.prompt, 'busy': False}
+
+    def rpc_console_destroy(self, c_id):
+        if self.consoles.pop(str(c_id), None) is None:
+            return {'result': 'failure'}
+        return {'result': 'success'}
+
+    def rpc_console_list(self):
+        now = time.time()
+        return {'consoles': [{'id': c.c_id, 'prompt': c.prompt, 'busy': c.busy(now)}
+                             for c in self.consoles.values()]}
+
+    def rpc_console_read(self, c_id):
+        console = self.get_console(c_id)
+        return {'data': self.take_output(console),
+                'prompt': console.prompt,
+                'busy': console.busy(time.time())}
+
+    def rpc_console_write(self, c_id, data):
+        console = self.get_console(c_id)
+        self.run_console_cmd(console, data)
+        return {'wrote': len(data)}
+
+    def rpc_module_execute(self, mod_type, name, opts=None):
+        job = self.start_job(mod_type, name, opts or {})
+        return {'job_id': job.job_id, 'uuid': job.uuid}
+
+    def rpc_job_list(self):
+        self.reap_jobs()
+        return dict((str(j.job_id), j.name) for j in self.jobs.values())
+
+    def rpc_job_info(self, job_id):
+        job = self.get_job(job_id)
+        return {'jid': job.job_id,
+                'name': job.name,
+                'start_time': job.start_time,
+                'datastore': job.datastore}
+
+    def rpc_job_stop(self, job_id):
+        job = self.get_job(job_id)
+        del self.jobs[job.job_id]
+        return {'result': 'success'}
+
+    def rpc_session_list(self):
+        self.spawn_due_sessions()
+        self.reap_jobs()
+        return dict((n, s.info()) for n, s in self.sessions.items() if not s.dead)
+
+    def rpc_session_stop(self, sess_num):
+        self.get_session(sess_num).dead = True
+        return {'result': 'success'}
+
+    def rpc_session_meterpreter_read(self, sess_num):
+        sess = self.get_session(sess_num)
+        return {'data': self.take_output(sess)}
+
+    def rpc_session_meterpreter_write(self, sess_num, data):
+        sess = self.get_session(sess_num)
+        self.run_session_cmd(sess, data)
+        return {'result': 'success'}
+
+    def rpc_session_meterpreter_run_single(self, sess_num, data):
+        sess = self.get_session(sess_num)
+        self.run_session_cmd(sess, data)
+        return {'result': 'success'}
+
+class RpcError(Exception):
+
+    def __init__(self, msg, code=500):
+        self.msg = msg
+        self.code = code
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, without this every
+    # keep-alive response waits on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        request = msgpack.unpackb(self.rfile.read(length), raw=False)
+        request = [x.decode('utf8') if isinstance(x, bytes) else x for x in request]
+        method, args = request[0], request[1:]
+
+        server.sleep()
+        code = 200
+        with server.state_lock:
+            server.count(method)
+            try:
+                result = server.dispatch(method, args)
+            except RpcError as e:
+                code = e.code
+                result = {'error': True,
+                          'error_class': 'Msf::RPC::Exception',
+                          'error_string': e.msg,
+                          'error_message': e.msg}
+            except TypeError as e:
+                code = 500
+                result = {'error': True,
+                          'error_class': 'ArgumentError',
+                          'error_string': str(e),
+                          'error_message': str(e)}
+
+        body = msgpack.packb(result, use_bin_type=False)
+        self.send_response(code)
+        self.send_header('Content-Type', 'binary/message-pack')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def load_fixtures(path):
+    if not path:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def main():
+    args = parse_args()
+    server = MsfrpcdSim((args.host, args.port),
+                        username=args.username,
+                        password=args.password,
+                        fixtures=load_fixtures(args.fixtures),
+                        sessions=args.sessions,
+                        session_interval=args.session_interval,
+                        admin_every=args.admin_every,
+                        consoles=args.consoles,
+                        latency=args.latency,
+                        jitter=args.jitter,
+                        cmd_delay=args.cmd_delay,
+                        seed=args.seed)
+    print('[*] Simulated msfrpcd listening on {}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sys.exit()
+
+if __name__ == "__main__":
+    main()